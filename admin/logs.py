@@ -0,0 +1,57 @@
+# IMPORTS
+import glob
+import json
+import os
+
+# types of security event that are logged, as they appear in the log
+EVENTS = ['Log in', 'Log Out', 'Invalid Login Attempt', 'User registration', 'Invalid access attempts']
+
+
+# returns the log file followed by the backups logrotate has made of it, newest first. Compressed backups aren't read
+def log_files(path):
+    backups = sorted((backup for backup in glob.glob(glob.escape(path) + '.*') if not backup.endswith('.gz')),
+                     key=os.path.getmtime, reverse=True)
+    return [path] + backups
+
+
+# reads the lines of a file from the end backwards a block at a time, so only as much of the file is read as needed
+def reverse_lines(path, block_size=8192):
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        # part of a line carried over from the start of the last block read
+        remainder = b''
+        while position > 0:
+            size = min(block_size, position)
+            position -= size
+            f.seek(position)
+            lines = (f.read(size) + remainder).split(b'\n')
+            # the first line of the block may carry on in the block before it
+            remainder = lines.pop(0)
+            for line in reversed(lines):
+                if line:
+                    yield line.decode('utf-8', 'replace')
+        if remainder:
+            yield remainder.decode('utf-8', 'replace')
+
+
+# checks if a log line records the given type of event, in either the JSON format or the older text format
+def logs_event(line, event):
+    return '"event": %s' % json.dumps(event) in line or 'SECURITY - %s [' % event in line
+
+
+# returns the last n lines of the log across its rotated backups, newest first. If an event type is given, only lines
+# logging that event are returned and reading stops as soon as n of them have been found
+def tail(path, n, event=None):
+    entries = []
+    if n <= 0:
+        return entries
+    for log_file in log_files(path):
+        if not os.path.exists(log_file):
+            continue
+        for line in reverse_lines(log_file):
+            if event is None or logs_event(line, event):
+                entries.append(line)
+                if len(entries) == n:
+                    return entries
+    return entries
@@ -1,14 +1,27 @@
 # IMPORTS
-from flask import Blueprint, render_template, request, flash
+from flask import Blueprint, render_template, request, flash, current_app, jsonify, Response
+from sqlalchemy import func, tuple_
 from sqlalchemy.orm import make_transient
 from app import db, roles_required
-from models import User, Draw
+from response_cache import cached, invalidate
+from models import User, Draw, Job, NumberCount, cipher_cache_info
+from lottery.jobs import enqueue_round, progress
+from lottery.bulk import validate
+from lottery.rounds import rounds_page
+from lottery.frequency import histogram
+from admin.logs import EVENTS, tail
 from flask_login import login_required, current_user
 
 # CONFIG
 admin_blueprint = Blueprint('admin', __name__, template_folder='templates')
 
 
+# makes the types of logged security event available to the admin page's log filter
+@admin_blueprint.context_processor
+def log_events():
+    return {'events': EVENTS}
+
+
 # VIEWS
 # view admin homepage
 @admin_blueprint.route('/admin')
@@ -18,14 +31,63 @@ def admin():
     return render_template('admin/admin.html', name=current_user.firstname)
 
 
-# view all registered users
+# columns users can be searched by the start of, each read in order from an index on the column
+SEARCH_COLUMNS = {'email': User.email, 'lastname': User.lastname}
+
+
+# loads one page of registered users, optionally only those whose email or last name starts with the search. Users are
+# ordered by email, or by last name if that is what is searched, and a page starts after the last user of the page
+# before rather than at an offset, so every page is read from the index on the user's role and that column and takes
+# the same time to load. The number of draws each user has entered is counted for the whole page with one grouped
+# query. Returns the users on the page and where the next page starts, or None on the last page
+def users_page(values):
+    per_page = current_app.config['USERS_PER_PAGE']
+    search = values.get('search', '').strip()
+    by = values.get('by') if values.get('by') in SEARCH_COLUMNS else 'email'
+    after_id = values.get('after_id', type=int)
+    column = SEARCH_COLUMNS[by]
+
+    query = db.session.query(User.id, User.email, User.firstname, User.lastname, User.phone, User.role) \
+        .filter(User.role == 'user')
+    if search:
+        # a range rather than LIKE, so the search reads the part of the index starting with it
+        query = query.filter(column >= search, column < search[:-1] + chr(ord(search[-1]) + 1))
+    if after_id is not None:
+        query = query.filter(tuple_(column, User.id) > (values.get('after_key', ''), after_id))
+    query = query.order_by(column, User.id)
+    rows = query.limit(per_page + 1).all()
+
+    next_page = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_page = {'search': search, 'by': by, 'after_id': rows[-1].id, 'after_key': getattr(rows[-1], by)}
+
+    draws = dict(db.session.query(Draw.user_id, func.count(Draw.id))
+                 .filter(Draw.user_id.in_([row.id for row in rows]))
+                 .group_by(Draw.user_id))
+    users = [dict(row._mapping, draws=draws.get(row.id, 0)) for row in rows]
+    return users, next_page
+
+
+# view registered users, a page at a time
 @admin_blueprint.route('/view_all_users', methods=['POST'])
 @login_required
 @roles_required('admin')
 def view_all_users():
-    current_users = User.query.filter_by(role='user').all()
+    current_users, next_page = users_page(request.form)
+
+    return render_template('admin/admin.html', name=current_user.firstname, current_users=current_users,
+                           next_page=next_page, search=request.form.get('search', '').strip(),
+                           by=request.form.get('by'))
 
-    return render_template('admin/admin.html', name=current_user.firstname, current_users=current_users)
+
+# a page of registered users as JSON, so the admin page can load more users as they are needed
+@admin_blueprint.route('/users')
+@login_required
+@roles_required('admin')
+def users():
+    current_users, next_page = users_page(request.args)
+    return jsonify({'users': current_users, 'next': next_page})
 
 
 # create a new winning draw
@@ -33,6 +95,11 @@ def view_all_users():
 @login_required
 @roles_required('admin')
 def create_winning_draw():
+    # checks the form holds six different whole numbers between 1 and 60, as the round is played against them
+    submitted_draw, error = validate([request.form.get('no' + str(i + 1), '') for i in range(6)])
+    if error:
+        flash("Winning draw not added. %s." % error)
+        return admin()
 
     # get current winning draw
     current_winning_draw = Draw.query.filter_by(master_draw=True).first()
@@ -43,16 +110,14 @@ def create_winning_draw():
         # update lottery round by 1
         lottery_round = current_winning_draw.lottery_round + 1
 
-        # delete current winning draw
-        db.session.delete(current_winning_draw)
+        # delete current winning draw, unless its round is queued or being played. The check is made by the delete
+        # itself, so a round can't be queued in between
+        playing = db.session.query(Job.id).filter(Job.status.in_((Job.QUEUED, Job.RUNNING))).exists()
+        deleted = Draw.query.filter(Draw.id == current_winning_draw.id, ~playing).delete(synchronize_session=False)
         db.session.commit()
-
-    # get new winning draw entered in form
-    submitted_draw = ''
-    for i in range(6):
-        submitted_draw += request.form.get('no' + str(i + 1)) + ' '
-    # remove any surrounding whitespace
-    submitted_draw.strip()
+        if not deleted:
+            flash("Winning draw not added. Round %d is still being played." % current_winning_draw.lottery_round)
+            return admin()
 
     # create a new draw object with the form data.
     new_winning_draw = Draw(user_id=current_user.id, numbers=submitted_draw, master_draw=True,
@@ -61,6 +126,7 @@ def create_winning_draw():
     # add the new winning draw to the database
     db.session.add(new_winning_draw)
     db.session.commit()
+    invalidate()
 
     # re-render admin page
     flash("New winning draw added.")
@@ -71,6 +137,7 @@ def create_winning_draw():
 @admin_blueprint.route('/view_winning_draw', methods=['POST'])
 @login_required
 @roles_required('admin')
+@cached()
 def view_winning_draw():
 
     # get winning draw from DB
@@ -90,7 +157,7 @@ def view_winning_draw():
     return admin()
 
 
-# view lottery results and winners
+# queue a round of the lottery to be played in the background
 @admin_blueprint.route('/run_lottery', methods=['POST'])
 @login_required
 @roles_required('admin')
@@ -102,67 +169,121 @@ def run_lottery():
     # if current unplayed winning draw exists
     if current_winning_draw:
 
-        # get all unplayed user draws
-        user_draws = Draw.query.filter_by(master_draw=False, been_played=False).all()
-        results = []
+        # queue the round, or get it if it has already been queued
+        job = enqueue_round(current_winning_draw)
 
         # if at least one unplayed user draw exists
-        if user_draws:
+        if job:
+            return lottery_job_page(job)
 
-            # update current winning draw as played
-            current_winning_draw.been_played = True
-            db.session.add(current_winning_draw)
-            db.session.commit()
+        flash("No user draws entered.")
+        return admin()
 
-            # for each unplayed user draw
-            for draw in user_draws:
+    # if current unplayed winning draw does not exist
+    flash("Current winning draw expired. Add new winning draw for next round.")
+    return admin()
 
-                # get the owning user (instance/object)
-                user = User.query.filter_by(id=draw.user_id).first()
-                # decrypts the numbers in the draw so numbers can be accessed to check
-                draw.view_draw(user.drawkey)
 
-                # if user draw matches current unplayed winning draw
-                if draw.numbers == current_winning_draw.numbers:
+# renders the admin page with the progress of a lottery round, and its results and winners once it is done
+def lottery_job_page(job):
+    job = progress(job)
+    if job['status'] == Job.DONE:
+        # if no winners
+        if len(job['results']) == 0:
+            flash("No winners.")
+        return render_template('admin/admin.html', job=job, results=[tuple(result) for result in job['results']],
+                               tiers=job['tiers'], throughput=job, name=current_user.firstname)
+    return render_template('admin/admin.html', job=job, name=current_user.firstname)
 
-                    # add details of winner to list of results
-                    results.append((current_winning_draw.lottery_round, draw.numbers, draw.user_id, user.email))
 
-                    # update draw as a winning draw (this will be used to highlight winning draws in the user's
-                    # lottery page)
-                    draw.matches_master = True
+# view the progress of the latest lottery round
+@admin_blueprint.route('/lottery_job', methods=['POST'])
+@login_required
+@roles_required('admin')
+def lottery_job():
+    job = Job.query.filter(Job.id == db.session.query(func.max(Job.id)).scalar_subquery()).first()
 
-                # update draw as played
-                draw.been_played = True
+    if job:
+        return lottery_job_page(job)
 
-                # update draw with current lottery round
-                draw.lottery_round = current_winning_draw.lottery_round
+    flash("No lottery rounds have been run.")
+    return admin()
 
-                # commit draw changes to DB
-                db.session.add(draw)
-                db.session.commit()
 
-            # if no winners
-            if len(results) == 0:
-                flash("No winners.")
+# view the summaries of played lottery rounds, a page at a time
+@admin_blueprint.route('/round_history', methods=['POST'])
+@login_required
+@roles_required('admin')
+def round_history():
+    rounds, next_before = rounds_page(request.form.get('before', type=int))
 
-            return render_template('admin/admin.html', results=results, name=current_user.firstname)
+    if rounds:
+        return render_template('admin/admin.html', rounds=rounds, next_before=next_before,
+                               name=current_user.firstname)
 
-        flash("No user draws entered.")
-        return admin()
+    flash("No lottery rounds have been run.")
+    return admin()
 
-    # if current unplayed winning draw does not exist
-    flash("Current winning draw expired. Add new winning draw for next round.")
+
+# view how many draws picked each number, in one round, in the draws not played yet, or in every played round
+@admin_blueprint.route('/number_frequency', methods=['POST'])
+@login_required
+@roles_required('admin')
+def number_frequency():
+    lottery_round = request.form.get('lottery_round', NumberCount.TOTAL, type=int)
+    frequency = histogram(lottery_round)
+
+    if frequency:
+        return render_template('admin/admin.html', frequency=frequency, frequency_round=lottery_round,
+                               name=current_user.firstname)
+
+    flash("No numbers have been counted for round %d." % lottery_round)
     return admin()
 
 
-# view last 10 log entries
+# progress of a lottery round as JSON, for polling
+@admin_blueprint.route('/lottery_job/<int:job_id>')
+@login_required
+@roles_required('admin')
+def lottery_job_progress(job_id):
+    job = db.session.get(Job, job_id)
+    if job is None:
+        return jsonify({'error': 'No such lottery round.'}), 404
+    return jsonify(progress(job))
+
+
+# view the last entries of the security log, optionally only those of one type of event
 @admin_blueprint.route('/logs', methods=['POST'])
 @login_required
 @roles_required('admin')
 def logs():
-    with open("lottery.log", "r") as f:
-        content = f.read().splitlines()[-10:]
-        content.reverse()
+    lines = min(request.form.get('lines', 10, type=int), current_app.config['LOG_TAIL_MAX'])
+    event = request.form.get('event') if request.form.get('event') in EVENTS else None
+    content = tail(current_app.config['LOG_FILE'], lines, event)
+
+    return render_template('admin/admin.html', logs=content, lines=lines, event=event,
+                           dropped=current_app.extensions['security_log'].dropped, name=current_user.firstname)
+
+
+# view hit and miss counts of the in-process caches
+@admin_blueprint.route('/cache_stats', methods=['POST'])
+@login_required
+@roles_required('admin')
+def cache_stats():
+    fernet = cipher_cache_info()
+    stats = {'Identities': current_app.extensions['identity_cache'].stats(),
+             'Responses': current_app.extensions['response_cache'].stats(),
+             'Draw keys': {'hits': fernet.hits, 'misses': fernet.misses, 'size': fernet.currsize,
+                           'maxsize': fernet.maxsize}}
+
+    return render_template('admin/admin.html', cache_stats=stats, name=current_user.firstname)
+
 
-    return render_template('admin/admin.html', logs=content, name=current_user.firstname)
+# request timings and query counts for each endpoint, and the security events this process has dropped, in the
+# prometheus text format
+@admin_blueprint.route('/metrics')
+@login_required
+@roles_required('admin')
+def view_metrics():
+    text = current_app.extensions['metrics'].prometheus() + current_app.extensions['security_log'].prometheus()
+    return Response(text, mimetype='text/plain; version=0.0.4')
@@ -1,49 +1,145 @@
 # IMPORTS
-from flask import Flask, render_template, request
+from flask import Flask, render_template, current_app
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import current_user, LoginManager
 from dotenv import load_dotenv
 from functools import wraps
 from flask_talisman import Talisman
+from sqlalchemy import event
+from cache import TTLCache
+from metrics import Metrics
+from response_cache import ResponseCache, cached
+from rate_limit import RateLimiter, count_attempt
+from security_log import SecurityFilter, JSONFormatter, BatchFileHandler, BlockingQueueHandler, BatchingQueueListener, \
+    log_security
+import atexit
 import logging
 import os
+import sqlite3
 
+# extensions are created without an app and bound to each app made by create_app, so modules can import them without
+# building an app
+db = SQLAlchemy()
+login_manager = LoginManager()
+
+# writes queued security events to the log file. There is one per process, however many apps are created
+log_listener = None
+
+
+# reads the app's settings from the environment
+def config_from_env():
+    config = {}
+    config['SECRET_KEY'] = os.getenv('SECRET_KEY')
+    config['SQLALCHEMY_DATABASE_URI'] = os.getenv('SQLALCHEMY_DATABASE_URI')
+    config['SQLALCHEMY_ECHO'] = os.getenv('SQLALCHEMY_ECHO') == 'True'
+    config['SQLALCHEMY_TRACK_MODIFICATIONS'] = os.getenv('SQLALCHEMY_TRACK_MODIFICATIONS') == 'True'
+    # connection pool settings. Only the ones that are set are passed to the engine, as the pools SQLite uses for in
+    # memory databases don't take all of them
+    engine_options = {}
+    if os.getenv('SQLALCHEMY_POOL_SIZE'):
+        engine_options['pool_size'] = int(os.getenv('SQLALCHEMY_POOL_SIZE'))
+    if os.getenv('SQLALCHEMY_MAX_OVERFLOW'):
+        engine_options['max_overflow'] = int(os.getenv('SQLALCHEMY_MAX_OVERFLOW'))
+    if os.getenv('SQLALCHEMY_POOL_RECYCLE'):
+        engine_options['pool_recycle'] = int(os.getenv('SQLALCHEMY_POOL_RECYCLE'))
+    if os.getenv('SQLALCHEMY_POOL_PRE_PING'):
+        engine_options['pool_pre_ping'] = os.getenv('SQLALCHEMY_POOL_PRE_PING') == 'True'
+    config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options
+    # SQLite journal mode, how many milliseconds to wait for another connection's lock and how often to sync to disk.
+    # WAL lets requests read while another writes, and NORMAL only syncs at checkpoints, which is safe in WAL mode
+    config['SQLITE_JOURNAL_MODE'] = os.getenv('SQLITE_JOURNAL_MODE', 'WAL').upper()
+    config['SQLITE_BUSY_TIMEOUT'] = int(os.getenv('SQLITE_BUSY_TIMEOUT', 5000))
+    config['SQLITE_SYNCHRONOUS'] = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL').upper()
+    config['RECAPTCHA_PUBLIC_KEY'] = os.getenv('RECAPTCHA_PUBLIC_KEY')
+    config['RECAPTCHA_PRIVATE_KEY'] = os.getenv('RECAPTCHA_PRIVATE_KEY')
+    # number of draw keys whose Fernet instances are kept in memory
+    config['FERNET_CACHE_SIZE'] = int(os.getenv('FERNET_CACHE_SIZE', 1024))
+    # cost factor used to hash passwords, number of passwords hashed at once and number of hashes allowed to wait for
+    # their turn
+    config['BCRYPT_ROUNDS'] = int(os.getenv('BCRYPT_ROUNDS', 12))
+    config['BCRYPT_WORKERS'] = int(os.getenv('BCRYPT_WORKERS', os.cpu_count() or 1))
+    config['BCRYPT_QUEUE_SIZE'] = int(os.getenv('BCRYPT_QUEUE_SIZE', 32))
+    # number of logged in users kept in the identity cache and how many seconds each one is kept for
+    config['IDENTITY_CACHE_SIZE'] = int(os.getenv('IDENTITY_CACHE_SIZE', 1000))
+    config['IDENTITY_CACHE_TTL'] = int(os.getenv('IDENTITY_CACHE_TTL', 60))
+    # number of failed attempts (logins, registrations and denied pages) a client or email can make within the window
+    # of seconds, and the number of clients and emails whose attempts are kept
+    config['RATE_LIMIT_ATTEMPTS'] = int(os.getenv('RATE_LIMIT_ATTEMPTS', 5))
+    config['RATE_LIMIT_WINDOW'] = int(os.getenv('RATE_LIMIT_WINDOW', 300))
+    config['RATE_LIMIT_SIZE'] = int(os.getenv('RATE_LIMIT_SIZE', 10000))
+    # number of rendered pages kept in the response cache and how many seconds each one is kept for
+    config['RESPONSE_CACHE_SIZE'] = int(os.getenv('RESPONSE_CACHE_SIZE', 1000))
+    config['RESPONSE_CACHE_TTL'] = int(os.getenv('RESPONSE_CACHE_TTL', 300))
+    # key used to fingerprint draw numbers so jackpot winners can be looked up without decrypting them. It must be set,
+    # and once it is changed the fingerprints have to be rebuilt with flask backfill-fingerprints --all
+    config['DRAW_FINGERPRINT_KEY'] = os.getenv('DRAW_FINGERPRINT_KEY')
+    # security log file. Every worker process appends to it, so it is rotated by an outside tool such as logrotate
+    # rather than by the app
+    config['LOG_FILE'] = os.getenv('LOG_FILE', 'lottery.log')
+    # number of security events that can wait to be written, how many seconds a request waits for space when they are
+    # full and the most events written at once
+    config['LOG_QUEUE_SIZE'] = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+    config['LOG_QUEUE_TIMEOUT'] = float(os.getenv('LOG_QUEUE_TIMEOUT', 1))
+    config['LOG_BATCH_SIZE'] = int(os.getenv('LOG_BATCH_SIZE', 100))
+    # most entries of the security log that can be viewed at once
+    config['LOG_TAIL_MAX'] = int(os.getenv('LOG_TAIL_MAX', 1000))
+    # most draws that can be submitted in one bulk submission, and number of draws inserted per statement
+    config['BULK_DRAW_LIMIT'] = int(os.getenv('BULK_DRAW_LIMIT', 5000))
+    config['BULK_INSERT_BATCH'] = int(os.getenv('BULK_INSERT_BATCH', 500))
+    # number of draws shown on each page of a user's draws
+    config['DRAWS_PER_PAGE'] = int(os.getenv('DRAWS_PER_PAGE', 50))
+    config['USERS_PER_PAGE'] = int(os.getenv('USERS_PER_PAGE', 50))
+    config['ROUNDS_PER_PAGE'] = int(os.getenv('ROUNDS_PER_PAGE', 20))
+    # number of threads running queued lottery rounds, how often idle threads check for new rounds, and how long a
+    # running round can go without a heartbeat before it is taken over by another thread
+    config['JOB_WORKERS'] = int(os.getenv('JOB_WORKERS', 1))
+    config['JOB_POLL_INTERVAL'] = float(os.getenv('JOB_POLL_INTERVAL', 5))
+    config['JOB_STALE_SECONDS'] = float(os.getenv('JOB_STALE_SECONDS', 120))
+    # number of draws loaded and checked at a time when running the lottery, and number of processes used to check them
+    config['LOTTERY_CHUNK_SIZE'] = int(os.getenv('LOTTERY_CHUNK_SIZE', 5000))
+    config['LOTTERY_WORKERS'] = int(os.getenv('LOTTERY_WORKERS', os.cpu_count() or 1))
+    # logs requests that run more database queries than the query budget
+    config['METRICS_DEBUG'] = os.getenv('METRICS_DEBUG') == 'True'
+    config['METRICS_QUERY_BUDGET'] = int(os.getenv('METRICS_QUERY_BUDGET', 20))
+    return config
+
+
+# sends security events to the log file. Requests only put events on a queue, and a background listener writes them to
+# the file in batches. This is only done for the first app created, as every app logs through the root logger
+def init_logging(config):
+    global log_listener
+    if log_listener is not None:
+        return
+
+    # opens a log file(if doesn't exist creates log file) to write logs too
+    file_handler = BatchFileHandler(config['LOG_FILE'])
+    # writes each security event as a line of JSON
+    file_handler.setFormatter(JSONFormatter())
+    log_listener = BatchingQueueListener(file_handler, config['LOG_QUEUE_SIZE'], config['LOG_BATCH_SIZE'])
+    queue_handler = BlockingQueueHandler(log_listener, config['LOG_QUEUE_TIMEOUT'])
+    # only queues logs of level warning and above
+    queue_handler.setLevel(logging.WARNING)
+    # filters through the logs so that only security events will be written to the file
+    queue_handler.addFilter(SecurityFilter())
+    # adds the queue handler to the root logger so that the route logger will send the appropriate log messages to it
+    logging.getLogger().addHandler(queue_handler)
+    # writes out any queued events when the app shuts down
+    atexit.register(log_listener.stop)
+
+
+# applies an app's SQLite settings to each new connection its engine opens, as SQLite only keeps them for the
+# connection they are set on
+def sqlite_settings(config):
+    def configure(dbapi_connection, connection_record):
+        if isinstance(dbapi_connection, sqlite3.Connection):
+            cursor = dbapi_connection.cursor()
+            cursor.execute('PRAGMA journal_mode=%s' % config['SQLITE_JOURNAL_MODE'])
+            cursor.execute('PRAGMA busy_timeout=%d' % config['SQLITE_BUSY_TIMEOUT'])
+            cursor.execute('PRAGMA synchronous=%s' % config['SQLITE_SYNCHRONOUS'])
+            cursor.close()
+
+    return configure
 
-# defines a filter class that will only return logged messages with the string SECURITY in
-class SecurityFilter(logging.Filter):
-    def filter(self, record):
-        return 'SECURITY' in record.getMessage()
-
-
-# provides access to the root logger to interact with
-logger = logging.getLogger()
-# opens a log file(if doesn't exist creates log file) to write logs too
-file_handler = logging.FileHandler('lottery.log', 'a')
-# only writes logs of level warning and below to the file handler
-file_handler.setLevel(logging.WARNING)
-# filters through the logs so that only logs containing the keyword SECURITY will be written to the file
-file_handler.addFilter(SecurityFilter())
-# defines a formatter that defines the format in which logs will be displayed through
-formatter = logging.Formatter('%(asctime)s : %(message)s', '%m/%d/%Y %I:%M:%S %p')
-# assigns the formatter to the file handler so that logs will be displayed in the layout provided by the formatter
-file_handler.setFormatter(formatter)
-# adds the file handler to the root logger so that the route logger will send the appropriate log messages to it
-logger.addHandler(file_handler)
-
-# loads data from env file to be accessed
-load_dotenv()
-
-# CONFIG
-app = Flask(__name__)
-app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
-app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('SQLALCHEMY_DATABASE_URI')
-app.config['SQLALCHEMY_ECHO'] = os.getenv('SQLALCHEMY_ECHO') == 'True'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = os.getenv('SQLALCHEMY_TRACK_MODIFICATIONS') == 'True'
-app.config['RECAPTCHA_PUBLIC_KEY'] = os.getenv('RECAPTCHA_PUBLIC_KEY')
-app.config['RECAPTCHA_PRIVATE_KEY'] = os.getenv('RECAPTCHA_PRIVATE_KEY')
-
-# initialise database
-db = SQLAlchemy(app)
 
 # added a custom security policy which whitelists certain sites and features within the lottery app so that they aren't
 # blocked by the default security headers
@@ -54,12 +150,6 @@ csp = {
                    'https://www.gstatic.com/recaptcha/']
 }
 
-# adds default security headers to http protocol with whitelisted sites defined in my custom security policy
-# adds permissions policy to prevent 3rd parties from tracking user session
-talisman = Talisman(app, content_security_policy=csp, permissions_policy="interest-cohort=()")
-# prevents website from blocking itself since it runs on http
-talisman.force_https = False
-
 
 # defined my own custom wrapper function which takes authorised roles as a parameter and redirects the user to the
 # forbidden error page if they do not have access to the page
@@ -69,8 +159,9 @@ def roles_required(*roles):
         def wrapped(*args, **kwargs):
             if current_user.role not in roles:
                 # logs logged on users attempting to access pages they don't have access too
-                logging.warning("SECURITY - Invalid access attempts [%d, %s, %s, %s]", current_user.id,
-                                current_user.email, current_user.role, request.remote_addr)
+                log_security('Invalid access attempts', current_user.id, current_user.email, current_user.role)
+                # counts against the user's login attempts
+                count_attempt(current_user.email)
                 return render_template('errors/403.html')
             return f(*args, **kwargs)
 
@@ -80,62 +171,135 @@ def roles_required(*roles):
 
 
 # HOME PAGE VIEW
-@app.route('/')
+@cached(per_user=False)
 def index():
     return render_template('main/index.html')
 
 
-# directs errors in the app to custom error pages
-@app.errorhandler(400)
+# directs errors in the app to custom error pages. These aren't cached, as the cache generations can't be read in a
+# request whose database session failed
 def bad_request_error(error):
     return render_template('errors/400.html')
 
 
-@app.errorhandler(403)
 def forbidden_error(error):
     return render_template('errors/403.html')
 
 
-@app.errorhandler(404)
 def not_found_error(error):
     return render_template('errors/404.html')
 
 
-@app.errorhandler(500)
 def internal_server_error(error):
+    # the error may have left the session part way through a failed transaction, which would fail loading the user
+    db.session.rollback()
     return render_template('errors/500.html')
 
 
-@app.errorhandler(503)
 def service_unavailable_error(error):
     return render_template('errors/503.html')
 
 
-# BLUEPRINTS
-# import blueprints
-from users.views import users_blueprint
-from admin.views import admin_blueprint
-from lottery.views import lottery_blueprint
-
-#
-# # register blueprints with app
-app.register_blueprint(users_blueprint)
-app.register_blueprint(admin_blueprint)
-app.register_blueprint(lottery_blueprint)
-
-from models import User
-
-# defines a login manager that sets a base page to send anonymous users
-login_manager = LoginManager()
-login_manager.login_view = 'user.login'
-login_manager.init_app(app)
-
-
-# loads instance of user from database
+# loads the identity of a user from the identity cache, or from the database if it isn't cached
 @login_manager.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    from models import User, Identity
+
+    identity_cache = current_app.extensions['identity_cache']
+    identity = identity_cache.get(int(id))
+    if identity is None:
+        user = User.query.get(int(id))
+        if user is None:
+            return None
+        identity = Identity(user)
+        identity_cache.set(identity.id, identity)
+    return identity
+
+
+# builds an app from the settings in the environment, with any given settings on top of them. The blueprints and the
+# models they use are only imported here, so importing this module is cheap
+def create_app(config=None):
+    # loads data from env file to be accessed
+    load_dotenv()
+
+    # CONFIG
+    app = Flask(__name__)
+    app.config.update(config_from_env())
+    app.config.update(config or {})
+    if app.config['SQLITE_JOURNAL_MODE'] not in ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF'):
+        raise ValueError('Unknown SQLITE_JOURNAL_MODE %s' % app.config['SQLITE_JOURNAL_MODE'])
+    if app.config['SQLITE_SYNCHRONOUS'] not in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+        raise ValueError('Unknown SQLITE_SYNCHRONOUS %s' % app.config['SQLITE_SYNCHRONOUS'])
+    if not app.config['DRAW_FINGERPRINT_KEY']:
+        raise ValueError('DRAW_FINGERPRINT_KEY must be set')
+
+    init_logging(app.config)
+    # the listener writing this process's security events, kept on each app so its dropped events can be reported
+    app.extensions['security_log'] = log_listener
+
+    # initialise database
+    db.init_app(app)
+    with app.app_context():
+        event.listen(db.engine, 'connect', sqlite_settings(app.config))
+
+    # keeps the identities of recently seen users so they don't have to be loaded from the database on every request
+    app.extensions['identity_cache'] = TTLCache(app.config['IDENTITY_CACHE_SIZE'], app.config['IDENTITY_CACHE_TTL'])
+
+    # records the time taken and database queries run by each request
+    app.extensions['metrics'] = Metrics(app)
+
+    # counts failed attempts per client and email, so clients making too many are turned away
+    app.extensions['rate_limiter'] = RateLimiter(app.config['RATE_LIMIT_ATTEMPTS'], app.config['RATE_LIMIT_WINDOW'],
+                                                 app.config['RATE_LIMIT_SIZE'])
+
+    # keeps rendered pages of read-mostly views, see response_cache
+    ResponseCache(app)
+
+    # adds default security headers to http protocol with whitelisted sites defined in my custom security policy
+    # adds permissions policy to prevent 3rd parties from tracking user session
+    # force_https is off to prevent website from blocking itself since it runs on http
+    # Talisman keeps its settings on itself rather than on the app, so each app gets its own
+    Talisman(app, content_security_policy=csp, permissions_policy="interest-cohort=()", force_https=False)
+
+    app.add_url_rule('/', 'index', index)
+    app.register_error_handler(400, bad_request_error)
+    app.register_error_handler(403, forbidden_error)
+    app.register_error_handler(404, not_found_error)
+    app.register_error_handler(500, internal_server_error)
+    app.register_error_handler(503, service_unavailable_error)
+
+    # BLUEPRINTS
+    # import blueprints
+    from users.views import users_blueprint
+    from admin.views import admin_blueprint
+    from lottery.views import lottery_blueprint
+    from models import init_models
+    from users.importer import import_users_command
+    from users.rotation import rotate_drawkeys_command
+    from lottery.rounds import backfill_rounds_command
+    from lottery.frequency import verify_number_counts_command
+    from lottery.fingerprints import backfill_fingerprints_command
+
+    # register blueprints with app
+    app.register_blueprint(users_blueprint)
+    app.register_blueprint(admin_blueprint)
+    app.register_blueprint(lottery_blueprint)
+
+    init_models(app)
+
+    # commands run with flask, e.g. flask import-users users.csv
+    app.cli.add_command(import_users_command)
+    app.cli.add_command(rotate_drawkeys_command)
+    app.cli.add_command(backfill_rounds_command)
+    app.cli.add_command(verify_number_counts_command)
+    app.cli.add_command(backfill_fingerprints_command)
+
+    # defines a login manager that sets a base page to send anonymous users
+    login_manager.login_view = 'user.login'
+    login_manager.init_app(app)
+
+    return app
 
 
 if __name__ == "__main__":
-    app.run()
+    create_app().run()
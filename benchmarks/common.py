@@ -0,0 +1,30 @@
+# IMPORTS
+import os
+import tempfile
+
+# numbers submitted as a draw, and as the winning draw, by the benchmarks
+NUMBERS = {'no1': 1, 'no2': 2, 'no3': 3, 'no4': 4, 'no5': 5, 'no6': 6}
+
+
+# points the app at a throwaway database and log in a new temporary directory, along with any other settings the
+# benchmark needs that aren't already configured. The database and log are always the throwaway ones, even if others
+# are configured, as seeding the database drops every table first. The database is kept in a file rather than in memory
+# as lottery rounds are played on a background thread. Has to be called before the app is created, as it reads its
+# settings from the environment
+def scratch_environment(name, **settings):
+    directory = tempfile.mkdtemp()
+    os.environ['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(directory, name + '.db')
+    os.environ['LOG_FILE'] = os.path.join(directory, name + '.log')
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    os.environ.setdefault('DRAW_FINGERPRINT_KEY', 'benchmark')
+    for key, value in settings.items():
+        os.environ.setdefault(key, value)
+
+
+# creates a test client of the app logged in as the given user without going through the login form
+def client_for(app, user_id):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+    return client
@@ -0,0 +1,79 @@
+# IMPORTS
+from benchmarks.common import NUMBERS, scratch_environment
+import argparse
+import threading
+import time
+
+# the writers run against a throwaway database and log. Logins hash with a low cost factor so the time is spent
+# waiting on the database rather than on bcrypt
+scratch_environment('concurrent_writers', BCRYPT_ROUNDS='4')
+
+from app import create_app, db
+from benchmarks.seed import PASSWORD, seed
+import pyotp
+
+app = create_app({'TESTING': True, 'WTF_CSRF_ENABLED': False})
+
+# SQLite settings compared, as (journal mode, synchronous)
+SETTINGS = [('DELETE', 'FULL'), ('WAL', 'NORMAL')]
+
+
+# logs a user in through the login form and then keeps submitting draws and logging in again until the time is up,
+# counting the requests that succeed and fail
+def writer(user, seconds, counts):
+    _, email, pinkey = user
+    client = app.test_client()
+    login = {'email': email, 'password': PASSWORD}
+    done = failed = 0
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        # every tenth request logs in again, which updates the user's login times. In testing, errors such as the
+        # database being locked are raised here rather than turned into an error page
+        try:
+            if done % 10 == 0:
+                ok = client.post('/login', data=dict(login, pin=pyotp.TOTP(pinkey).now())).status_code == 302
+            else:
+                ok = b'submitted.' in client.post('/add_draw', data=NUMBERS).data
+        except Exception:
+            ok = False
+        if ok:
+            done += 1
+        else:
+            failed += 1
+    counts.append((done, failed))
+
+
+# runs the writers on their own threads against the database opened with the given settings
+def run(journal_mode, synchronous, users, seconds):
+    app.config['SQLITE_JOURNAL_MODE'] = journal_mode
+    app.config['SQLITE_SYNCHRONOUS'] = synchronous
+    # connections are reopened so the settings are applied to them
+    with app.app_context():
+        db.engine.dispose()
+
+    counts = []
+    threads = [threading.Thread(target=writer, args=(user, seconds, counts)) for user in users]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    done = sum(count[0] for count in counts)
+    failed = sum(count[1] for count in counts)
+    print('%-8s %-8s %8d requests %6d failed %10.1f requests/sec' % (journal_mode, synchronous, done, failed,
+                                                                      done / seconds))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares write throughput of SQLite settings with concurrent writers.')
+    parser.add_argument('--writers', type=int, default=8, help='number of users writing at once')
+    parser.add_argument('--seconds', type=float, default=5, help='how long each setting is run for')
+    args = parser.parse_args()
+
+    users = seed(app, args.writers, 0, fast=True)
+    for journal_mode, synchronous in SETTINGS:
+        run(journal_mode, synchronous, users, args.seconds)
+
+
+if __name__ == '__main__':
+    main()
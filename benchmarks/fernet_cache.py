@@ -0,0 +1,52 @@
+# IMPORTS
+from cryptography.fernet import Fernet
+from models import cipher_cache_info, decrypt, decrypt_many
+import time
+
+# number of draws decrypted and number of users (draw keys) they are shared between
+DRAWS = 100000
+KEYS = 10
+
+
+# times a function over the given draws and prints how many draws it decrypted per second
+def report(name, function, draws):
+    start = time.perf_counter()
+    function(draws)
+    seconds = time.perf_counter() - start
+    print('%-30s %8.3fs %10.0f draws/sec' % (name, seconds, len(draws) / seconds))
+
+
+# decrypts every draw by setting up a new Fernet instance for its key, as encrypt and decrypt used to
+def uncached(draws):
+    for data, drawkey in draws:
+        Fernet(drawkey).decrypt(data).decode('utf-8')
+
+
+# decrypts every draw through the cached Fernet instances
+def cached(draws):
+    for data, drawkey in draws:
+        decrypt(data, drawkey)
+
+
+# decrypts the draws of each key in one batch
+def batched(draws):
+    by_key = {}
+    for data, drawkey in draws:
+        by_key.setdefault(drawkey, []).append(data)
+    for drawkey, rows in by_key.items():
+        decrypt_many(rows, drawkey)
+
+
+def main():
+    keys = [Fernet.generate_key() for i in range(KEYS)]
+    draws = [(Fernet(keys[i % KEYS]).encrypt(b'1 2 3 4 5 6'), keys[i % KEYS]) for i in range(DRAWS)]
+
+    print('%d draws shared between %d keys' % (DRAWS, KEYS))
+    report('Fernet per call', uncached, draws)
+    report('cached decrypt', cached, draws)
+    report('decrypt_many per key', batched, draws)
+    print(cipher_cache_info())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+# IMPORTS
+from benchmarks.common import NUMBERS, client_for, scratch_environment
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+# the benchmark runs against a throwaway database and log
+scratch_environment('hot_paths')
+
+from app import create_app
+from benchmarks.seed import PASSWORD, seed
+from lottery.jobs import progress
+from models import Job
+import pyotp
+
+# the response cache is turned off, so each request times the queries and rendering of the view rather than a cache hit
+app = create_app({'TESTING': True, 'WTF_CSRF_ENABLED': False, 'RESPONSE_CACHE_SIZE': 0})
+
+
+# returns the summary statistics of a list of request times in seconds
+def summarise(times):
+    ordered = sorted(times)
+    return {'count': len(ordered), 'mean': statistics.mean(ordered), 'p50': ordered[len(ordered) // 2],
+            'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 'max': ordered[-1]}
+
+
+# times a view requested the given number of times. Each request has to succeed for the timing to count
+def time_view(client, view, repeat, data=None):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = client.post(view, data=data)
+        times.append(time.perf_counter() - start)
+        if response.status_code not in (200, 302):
+            raise RuntimeError('%s returned %d' % (view, response.status_code))
+    return summarise(times)
+
+
+# times logging in through the login form, each time as a different user on a new client
+def time_login(users, repeat):
+    times = []
+    for i in range(repeat):
+        _, email, pinkey = users[i % len(users)]
+        client = app.test_client()
+        start = time.perf_counter()
+        response = client.post('/login', data={'email': email, 'password': PASSWORD,
+                                               'pin': pyotp.TOTP(pinkey).now()})
+        times.append(time.perf_counter() - start)
+        # a successful login redirects to the user's page
+        if response.status_code != 302:
+            raise RuntimeError('/login returned %d' % response.status_code)
+    return summarise(times)
+
+
+# creates a winning draw and plays the round, waiting for its background job to finish. Returns how long the round took
+# from the request to the job finishing, along with the job's own statistics
+def time_round(admin):
+    admin.post('/create_winning_draw', data=NUMBERS)
+    start = time.perf_counter()
+    admin.post('/run_lottery')
+    while True:
+        job = admin.post('/lottery_job')
+        if b'done' in job.data or b'failed' in job.data:
+            break
+        time.sleep(0.05)
+    seconds = time.perf_counter() - start
+    if b'failed' in job.data:
+        raise RuntimeError('the lottery round failed')
+    with app.app_context():
+        stats = progress(Job.query.order_by(Job.id.desc()).first())
+    return {'seconds': seconds, 'draws': stats['draws'], 'job_seconds': stats['seconds'],
+            'draws_per_second': stats['draws_per_second'], 'tiers': stats['tiers']}
+
+
+# seeds the database with one size of data set and times each hot path against it
+def run_size(users, draws, repeat, fast):
+    start = time.perf_counter()
+    seeded = seed(app, users, draws, fast)
+    seed_seconds = time.perf_counter() - start
+
+    # the user with the most draws is the one whose pages are timed
+    user = client_for(app, seeded[0][0])
+    # admin created by init_db
+    admin = client_for(app, 1)
+
+    timings = {'login': time_login(seeded, repeat),
+               'view_draws': time_view(user, '/view_draws', repeat),
+               'run_lottery': time_round(admin),
+               'check_draws': time_view(user, '/check_draws', repeat),
+               'add_draw': time_view(user, '/add_draw', repeat, NUMBERS)}
+    return {'users': users, 'draws': draws, 'seed_seconds': seed_seconds, 'timings': timings}
+
+
+# returns the commit being benchmarked, so results from different commits can be told apart
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Times the lottery hot paths at several sizes of data set.')
+    parser.add_argument('--users', type=int, default=100, help='number of users to seed')
+    parser.add_argument('--sizes', default='1000,10000', help='comma separated numbers of draws to seed')
+    parser.add_argument('--repeat', type=int, default=20, help='number of times each view is requested')
+    parser.add_argument('--fast', action='store_true',
+                        help='share one password hash between users and reuse encrypted draws to seed faster')
+    parser.add_argument('--output', help='file to write the JSON results to, instead of standard output')
+    args = parser.parse_args()
+
+    results = {'commit': commit(), 'python': platform.python_version(), 'fast': args.fast,
+               'bcrypt_rounds': app.config['BCRYPT_ROUNDS'], 'lottery_workers': app.config['LOTTERY_WORKERS'],
+               'results': [run_size(args.users, int(size), args.repeat, args.fast) for size in args.sizes.split(',')]}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+# IMPORTS
+from sqlalchemy import event
+from benchmarks.common import NUMBERS, client_for, scratch_environment
+import sys
+import time
+
+# the lottery is played against a throwaway database unless another one is configured
+scratch_environment('query_plans')
+
+from app import create_app, db
+from models import User, Draw
+
+# lottery and admin views whose queries are checked, in the order they are requested
+USER_VIEWS = ['/add_draw', '/add_draw', '/view_draws']
+ADMIN_VIEWS = ['/create_winning_draw', '/view_winning_draw', '/run_lottery', '/view_all_users']
+PLAYED_VIEWS = ['/check_draws', '/play_again']
+# a second round played straight after the first, in the usual order: the admin adds the next winning draw before the
+# users add their draws
+NEXT_WINNING_VIEWS = ['/create_winning_draw']
+NEXT_USER_VIEWS = ['/add_draw', '/add_draw']
+NEXT_ROUND_VIEWS = ['/run_lottery']
+
+app = create_app({'TESTING': True})
+
+
+# requests each view and returns every statement it ran against the database with its parameters
+def capture(client, views):
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if executemany:
+            parameters = parameters[0]
+        statements.append((statement, parameters))
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        for view in views:
+            response = client.post(view, data=NUMBERS)
+            if response.status_code != 200:
+                raise RuntimeError('%s returned %d' % (view, response.status_code))
+            # lottery rounds are played in the background, so wait for the round to finish
+            if view == '/run_lottery':
+                while True:
+                    page = client.post('/lottery_job').data
+                    if b': done,' in page:
+                        break
+                    if b': failed,' in page:
+                        raise RuntimeError('The lottery round failed')
+                    time.sleep(0.1)
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+    return statements
+
+
+# returns the query plan SQLite uses for a statement, one step per line
+def explain(statement, parameters):
+    with db.engine.connect() as connection:
+        return [row[-1] for row in connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters)]
+
+
+def main():
+    with app.app_context():
+        db.create_all()
+        admin = User(email='admin@email.com', password='Admin1!', firstname='Alice', lastname='Jones',
+                     phone='0191-123-4567', role='admin')
+        user = User(email='user@email.com', password='User1!', firstname='Bob', lastname='Smith',
+                    phone='0191-123-4567', role='user')
+        db.session.add_all([admin, user])
+        db.session.commit()
+        admin_id, user_id = admin.id, user.id
+
+    # each view runs in its own request, as it would when served
+    statements = capture(client_for(app, user_id), USER_VIEWS) + \
+        capture(client_for(app, admin_id), ADMIN_VIEWS) + \
+        capture(client_for(app, user_id), PLAYED_VIEWS) + \
+        capture(client_for(app, admin_id), NEXT_WINNING_VIEWS) + \
+        capture(client_for(app, user_id), NEXT_USER_VIEWS) + \
+        capture(client_for(app, admin_id), NEXT_ROUND_VIEWS) + \
+        capture(client_for(app, user_id), PLAYED_VIEWS)
+
+    # every played draw has been moved to the archive, so only the winning draws are left
+    with app.app_context():
+        left = Draw.query.filter_by(master_draw=False).count()
+    if left:
+        print('%d played draws were left in the draws table' % left)
+        sys.exit(1)
+
+    scans = 0
+    with app.app_context():
+        for statement, parameters in statements:
+            if not statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE')):
+                continue
+            plan = explain(statement, parameters)
+            # a SCAN step reads every row of a table (or of an index) instead of searching it
+            full_scans = [step for step in plan if step.startswith('SCAN')]
+            scans += len(full_scans)
+            print(('FULL SCAN ' if full_scans else 'ok        ') + ' '.join(statement.split()))
+            for step in plan:
+                print('              ' + step)
+
+    if scans:
+        print('%d full scans found' % scans)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+# IMPORTS
+from datetime import datetime
+from cryptography.fernet import Fernet
+from app import db
+from models import User, Draw, init_db
+from users.hashing import hash_password
+import pyotp
+import random
+
+# password every seeded user logs in with
+PASSWORD = 'Bench1!'
+# how many rows are inserted with each statement
+BATCH_SIZE = 1000
+# in fast mode each user's draws are picked from this many encrypted draws instead of encrypting every one
+FAST_POOL_SIZE = 20
+
+
+# picks six different numbers between 1 and 60 as a draw string
+def random_numbers(rng):
+    return ' '.join(str(number) for number in rng.sample(range(1, 61), 6))
+
+
+# inserts rows a batch at a time with one statement per batch
+def insert(table, rows):
+    rows = iter(rows)
+    while True:
+        batch = [row for _, row in zip(range(BATCH_SIZE), rows)]
+        if not batch:
+            return
+        db.session.execute(table.insert(), batch)
+
+
+# returns the column values of a seeded user. In fast mode every user shares one password hash instead of each being
+# hashed with bcrypt
+def user_values(i, password):
+    return {'email': 'user%d@bench.com' % i, 'password': password or hash_password(PASSWORD),
+            'firstname': 'User', 'lastname': 'Number%d' % i, 'phone': '0191-123-4567', 'role': 'user',
+            'registered_on': datetime.now(), 'drawkey': Fernet.generate_key(), 'pinkey': pyotp.random_base32()}
+
+
+# returns the column values of a user's seeded draws. In fast mode the draws are picked from a small pool of draws
+# encrypted with the user's key, otherwise every draw is encrypted on its own
+def draw_values(user_id, drawkey, count, rng, fast):
+    if fast:
+        pool = [Draw.values(user_id=user_id, numbers=random_numbers(rng), master_draw=False, lottery_round=0,
+                            drawkey=drawkey) for _ in range(min(count, FAST_POOL_SIZE))]
+        for i in range(count):
+            yield pool[i % len(pool)]
+    else:
+        for _ in range(count):
+            yield Draw.values(user_id=user_id, numbers=random_numbers(rng), master_draw=False, lottery_round=0,
+                              drawkey=drawkey)
+
+
+# resets the app's database to the admin created by init_db, then adds the given number of users and spreads the given
+# number of unplayed draws between them. Returns the seeded users as (id, email, pinkey)
+def seed(app, users, draws, fast=False, seed_value=0):
+    init_db(app)
+    rng = random.Random(seed_value)
+    with app.app_context():
+        # the ids of the users seeded before are given to new users, so their cached identities are out of date
+        app.extensions['identity_cache'].clear()
+        password = hash_password(PASSWORD) if fast else None
+        insert(User.__table__, (user_values(i, password) for i in range(users)))
+        db.session.commit()
+
+        seeded = db.session.query(User.id, User.email, User.pinkey, User.drawkey).filter(User.role == 'user') \
+            .order_by(User.id).all()
+        for i, (user_id, email, pinkey, drawkey) in enumerate(seeded):
+            # the draws are shared out as evenly as they can be
+            count = draws // users + (1 if i < draws % users else 0)
+            insert(Draw.__table__, draw_values(user_id, drawkey, count, rng, fast))
+        db.session.commit()
+    return [(user_id, email, pinkey) for user_id, email, pinkey, _ in seeded]
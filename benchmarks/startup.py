@@ -0,0 +1,64 @@
+# IMPORTS
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+# run in a new interpreter for each sample, so nothing has been imported yet. Prints the seconds taken to import the app
+# module, to create an app and to serve its first request
+SAMPLE = '''
+import time
+start = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+app = create_app({'TESTING': True})
+created = time.perf_counter()
+app.test_client().get('/')
+served = time.perf_counter()
+print(imported - start, created - imported, served - created)
+'''
+
+# run once before the samples to create the tables of the throwaway database
+SETUP = '''
+from models import init_db
+init_db()
+'''
+
+
+# times one cold start of a worker in a new process
+def sample(root, env):
+    output = subprocess.run([sys.executable, '-c', SAMPLE], cwd=root, env=env, capture_output=True, text=True,
+                            check=True).stdout
+    return [float(seconds) for seconds in output.split()[-3:]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Times how long a new worker takes to start and serve a request.')
+    parser.add_argument('--repeat', type=int, default=10, help='number of cold starts timed')
+    args = parser.parse_args()
+
+    # the app is started against a throwaway database and log, even if others are configured
+    directory = tempfile.mkdtemp()
+    env = dict(os.environ)
+    env['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(directory, 'startup.db')
+    env['LOG_FILE'] = os.path.join(directory, 'startup.log')
+    env.setdefault('SECRET_KEY', 'benchmark')
+    env.setdefault('DRAW_FINGERPRINT_KEY', 'benchmark')
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run([sys.executable, '-c', SETUP], cwd=root, env=env, capture_output=True, check=True)
+
+    samples = [sample(root, env) for _ in range(args.repeat)]
+    results = {}
+    for i, name in enumerate(['import', 'create_app', 'first_request']):
+        times = [seconds[i] for seconds in samples]
+        results[name] = {'median': statistics.median(times), 'min': min(times), 'max': max(times)}
+    results['total'] = {'median': statistics.median(sum(seconds) for seconds in samples)}
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
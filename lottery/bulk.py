@@ -0,0 +1,95 @@
+# IMPORTS
+from app import db
+from models import Draw, NumberCount, count_numbers
+from lottery.frequency import picks
+import csv
+import io
+
+# how many numbers are in a draw and the range they are picked from
+DRAW_SIZE = 6
+LOWEST, HIGHEST = 1, 60
+
+
+# raised when a bulk submission has more draws than are allowed in one go
+class TooManyDraws(Exception):
+    pass
+
+
+# raised when an uploaded file can't be read as a CSV file of UTF-8 text
+class BadUpload(Exception):
+    pass
+
+
+# reads the draws submitted as JSON, either a list of draws or an object with a "draws" list. Each draw can be a list
+# of numbers or a string of numbers separated by spaces
+def read_json(data):
+    draws = data.get('draws') if isinstance(data, dict) else data
+    if not isinstance(draws, list):
+        return []
+    return [draw.split() if isinstance(draw, str) else draw for draw in draws]
+
+
+# reads the draws in an uploaded CSV file, one draw of comma separated numbers per row, stopping as soon as the limit
+# has been passed so an oversized file isn't read in full
+def read_csv(file, limit):
+    draws = []
+    try:
+        for row in csv.reader(io.TextIOWrapper(file.stream, 'utf-8')):
+            if not any(value.strip() for value in row):
+                continue
+            draws.append([value for value in row if value.strip()])
+            if len(draws) > limit:
+                break
+    except (UnicodeDecodeError, csv.Error):
+        raise BadUpload()
+    return draws
+
+
+# reads a submitted number, which must be a whole number or a string of digits. Returns None for anything else, such as
+# a fraction or true and false, which int() would otherwise round or turn into 1 and 0
+def whole_number(number):
+    if isinstance(number, int) and not isinstance(number, bool):
+        return number
+    if isinstance(number, str) and number.strip().isascii() and number.strip().isdigit():
+        return int(number)
+    return None
+
+
+# checks a submitted draw is six different whole numbers between 1 and 60. Returns the draw's numbers as a string, and
+# None or the reason the draw was rejected
+def validate(draw):
+    if not isinstance(draw, list) or len(draw) != DRAW_SIZE:
+        return None, 'A draw must have %d numbers' % DRAW_SIZE
+    numbers = [whole_number(number) for number in draw]
+    if None in numbers:
+        return None, 'Numbers must be whole numbers'
+    if any(number < LOWEST or number > HIGHEST for number in numbers):
+        return None, 'Numbers must be between %d and %d' % (LOWEST, HIGHEST)
+    if len(set(numbers)) != DRAW_SIZE:
+        return None, 'Numbers must all be different'
+    return ' '.join(str(number) for number in numbers), None
+
+
+# validates, encrypts and inserts a user's submitted draws, inserting them a batch at a time with one statement per
+# batch and committing them all at once along with the counts of the numbers picked. Returns a summary saying whether
+# each draw was accepted and why not if it wasn't
+def submit_draws(draws, user_id, drawkey, limit, batch_size):
+    if len(draws) > limit:
+        raise TooManyDraws()
+
+    summary = []
+    batch = []
+    for row, draw in enumerate(draws, start=1):
+        numbers, error = validate(draw)
+        summary.append({'row': row, 'numbers': numbers, 'accepted': error is None, 'error': error})
+        if error is None:
+            batch.append(Draw.values(user_id=user_id, numbers=numbers, master_draw=False, lottery_round=0,
+                                     drawkey=drawkey))
+        if len(batch) == batch_size:
+            db.session.execute(Draw.__table__.insert(), batch)
+            batch = []
+    if batch:
+        db.session.execute(Draw.__table__.insert(), batch)
+    count_numbers(NumberCount.PENDING, picks(entry['numbers'] for entry in summary if entry['accepted']))
+    db.session.commit()
+    return summary
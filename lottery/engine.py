@@ -0,0 +1,200 @@
+# IMPORTS
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from sqlalchemy import bindparam, func
+from flask import current_app
+from app import db
+from models import User, Draw, NumberCount, Round, add_number_counts, archive_draws, count_numbers, decrypt, \
+    fingerprint, normalise
+import json
+import numpy as np
+import time
+
+# numbers of matching numbers that win a prize
+PRIZE_TIERS = (3, 4, 5, 6)
+
+
+# encodes draw numbers as a 64-bit mask with bit n set for number n, so two draws can be compared with a single AND.
+# Numbers outside the range of a mask can't match anything and are left out
+def bitmask(numbers):
+    mask = 0
+    for number in numbers.split():
+        if 0 < int(number) < 64:
+            mask |= 1 << int(number)
+    return mask
+
+
+# decrypts a chunk of user draws and encodes each one as a bitmask. This runs in a worker process, so it only takes and
+# returns plain values
+def score_chunk(rows):
+    ids = np.empty(len(rows), dtype=np.int64)
+    masks = np.empty(len(rows), dtype=np.uint64)
+    for i, (draw_id, numbers, drawkey) in enumerate(rows):
+        ids[i] = draw_id
+        masks[i] = bitmask(decrypt(numbers, drawkey))
+    return ids, masks
+
+
+# loads the unplayed user draws between the given ids joined to their owner's draw key, a chunk at a time in order of id
+def load_chunks(chunk_size, first_id, last_id):
+    while True:
+        rows = db.session.query(Draw.id, Draw.numbers, User.drawkey) \
+            .join(User, Draw.user_id == User.id) \
+            .filter(Draw.master_draw == False, Draw.been_played == False, Draw.id > first_id, Draw.id <= last_id) \
+            .order_by(Draw.id) \
+            .limit(chunk_size) \
+            .all()
+        if not rows:
+            return
+        first_id = rows[-1][0]
+        yield [tuple(row) for row in rows]
+
+
+# decrypts and encodes the draws of the round a chunk at a time, yielding each scored chunk in order of draw id. The
+# work is spread over a process pool when there is more than one chunk of draws
+def score_chunks(total, first_id, last_id):
+    chunk_size = current_app.config['LOTTERY_CHUNK_SIZE']
+    workers = current_app.config['LOTTERY_WORKERS']
+
+    # a few draws are scored here rather than paying to start up worker processes
+    if total <= chunk_size or workers <= 1:
+        for rows in load_chunks(chunk_size, first_id, last_id):
+            yield score_chunk(rows)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for rows in load_chunks(chunk_size, first_id, last_id):
+            pending.append(executor.submit(score_chunk, rows))
+            # only keep a couple of chunks per worker in flight so memory stays bounded
+            while len(pending) > workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+# marks a scored chunk of draws as played in the round, storing how many numbers each draw matched and flagging the
+# jackpot winners, with one bulk UPDATE for the chunk and one executemany for the match counts
+def play_chunk(lottery_round, ids, match_counts, winner_ids):
+    Draw.query.filter(Draw.master_draw == False, Draw.been_played == False,
+                      Draw.id.between(int(ids[0]), int(ids[-1]))) \
+        .update({'been_played': True, 'lottery_round': lottery_round}, synchronize_session=False)
+    if winner_ids:
+        Draw.query.filter(Draw.id.in_(winner_ids)).update({'matches_master': True}, synchronize_session=False)
+    db.session.execute(Draw.__table__.update().where(Draw.id == bindparam('draw_id')),
+                       [{'draw_id': int(draw_id), 'match_count': int(match_count)}
+                        for draw_id, match_count in zip(ids, match_counts)])
+
+
+# moves the counts of the numbers picked by a chunk of played draws from the pending counts to the counts of their
+# round and of all rounds. The numbers are counted from the bitmasks the draws were scored with, so nothing is
+# decrypted again
+def move_number_counts(lottery_round, masks):
+    bits = np.unpackbits(masks.astype('<u8').view(np.uint8).reshape(-1, 8), axis=1, bitorder='little').sum(axis=0)
+    counts = {number: int(bits[number]) for number in NumberCount.NUMBERS}
+    count_numbers(lottery_round, counts)
+    count_numbers(NumberCount.TOTAL, counts)
+    count_numbers(NumberCount.PENDING, {number: -count for number, count in counts.items()})
+
+
+# returns the number of unplayed user draws and the id of the last of them, which is where a round started now ends
+def unplayed_draws():
+    return db.session.query(func.count(Draw.id), func.max(Draw.id)) \
+        .filter(Draw.master_draw == False, Draw.been_played == False) \
+        .one()
+
+
+# plays the unplayed user draws up to last_id against the winning draw. Returns the list of jackpot winners and the
+# statistics of the round, including how many draws won in each prize tier.
+# Without a checkpoint the whole round is committed as a single transaction. A checkpoint is called with the id of the
+# last draw played, the number of draws played, the tier counts and the winners so far after each chunk of draws is
+# played, and commits the chunk along with its own progress. A round stopped partway through can then carry on from
+# where its last checkpoint got to by passing in first_id and what had been counted so far. finish is called with the
+# results and statistics just before the end of the round is committed, so it can record them in the same transaction.
+# The round's summary is kept up to date with each chunk, so it is committed along with the chunk's checkpoint
+def run_round(winning_draw, last_id, checkpoint=None, finish=None, first_id=0, processed=0, tiers=None,
+              winner_ids=None):
+    start = time.perf_counter()
+    # the winning draw is reloaded from its id whenever a checkpoint is committed, and a new winning draw can be given
+    # the id of a deleted one, so the round is played with the id and round the winning draw had when it started
+    winning_draw_id = winning_draw.id
+    lottery_round = winning_draw.lottery_round
+    tier_counts = np.zeros(7, dtype=np.int64)
+    for tier, count in (tiers or {}).items():
+        tier_counts[int(tier)] = count
+    winner_ids = list(winner_ids or [])
+
+    # the winning draw is encrypted with the key of the admin that created it
+    owner = db.session.get(User, winning_draw.user_id)
+    winning_numbers = normalise(decrypt(winning_draw.numbers, owner.drawkey))
+    winning_mask = np.uint64(bitmask(winning_numbers))
+
+    # a round carrying on from a checkpoint already has a summary
+    summary = db.session.get(Round, lottery_round)
+    if summary is None:
+        summary = Round(lottery_round, winning_numbers)
+        db.session.add(summary)
+    add_number_counts(lottery_round)
+
+    # jackpot winners are found with one indexed lookup on their fingerprint
+    jackpot_ids = np.array([draw_id for draw_id, in db.session.query(Draw.id)
+                           .filter(Draw.fingerprint == fingerprint(winning_numbers), Draw.master_draw == False,
+                                   Draw.been_played == False, Draw.id > first_id, Draw.id <= last_id)],
+                           dtype=np.int64)
+
+    remaining = Draw.query.filter(Draw.master_draw == False, Draw.been_played == False, Draw.id > first_id,
+                                  Draw.id <= last_id).count()
+    for ids, masks in score_chunks(remaining, first_id, last_id):
+        # count the matching numbers of every draw in the chunk at once
+        match_counts = np.bitwise_count(masks & winning_mask)
+        tier_counts += np.bincount(match_counts, minlength=7)
+        chunk_winner_ids = ids[np.isin(ids, jackpot_ids)]
+        # the draws matching all six numbers are the ones found by their fingerprint unless a fingerprint is missing
+        # or was made with another key, in which case the round stops before the chunk is played rather than leaving
+        # a winner out
+        if not np.array_equal(chunk_winner_ids, ids[match_counts == 6]):
+            raise RuntimeError('Draw fingerprints are out of date. Run flask backfill-fingerprints --all and run round '
+                               '%d again.' % lottery_round)
+        chunk_winner_ids = [int(draw_id) for draw_id in chunk_winner_ids]
+
+        play_chunk(lottery_round, ids, match_counts, chunk_winner_ids)
+        move_number_counts(lottery_round, masks)
+        processed += len(ids)
+        winner_ids += chunk_winner_ids
+        summary.entries = processed
+        summary.tiers = json.dumps({tier: int(tier_counts[tier]) for tier in PRIZE_TIERS})
+        if checkpoint:
+            checkpoint(int(ids[-1]), processed, {tier: int(tier_counts[tier]) for tier in PRIZE_TIERS}, winner_ids)
+
+    # update current winning draw as played and commit the rest of the round along with moving it to the archive. The
+    # winning draw is checked to still be the one the round was started with in the same transaction, in case it was
+    # deleted and replaced while the round was played
+    played = Draw.query.filter(Draw.id == winning_draw_id, Draw.master_draw == True,
+                               Draw.lottery_round == lottery_round, Draw.been_played == False) \
+        .update({'been_played': True}, synchronize_session=False)
+    if not played:
+        raise RuntimeError('The winning draw for round %d is no longer available.' % lottery_round)
+
+    winners = db.session.query(Draw.user_id, User.email) \
+        .join(User, Draw.user_id == User.id) \
+        .filter(Draw.id.in_(winner_ids)) \
+        .order_by(Draw.id) \
+        .all() if winner_ids else []
+    results = [(lottery_round, winning_numbers, user_id, email) for user_id, email in winners]
+
+    # the round's draws are moved to the archive now they have all been played
+    archive_draws(Draw.lottery_round == lottery_round)
+
+    seconds = time.perf_counter() - start
+    stats = {'draws': processed, 'seconds': seconds, 'draws_per_second': processed / seconds if seconds else 0.0,
+             'tiers': {tier: int(tier_counts[tier]) for tier in PRIZE_TIERS}}
+    summary.entries = processed
+    summary.tiers = json.dumps(stats['tiers'])
+    summary.winner_ids = json.dumps(sorted({user_id for user_id, _ in winners}))
+    summary.seconds += seconds
+    summary.finished_on = datetime.now()
+    if finish:
+        finish(results, stats)
+    db.session.commit()
+    return results, stats
@@ -0,0 +1,45 @@
+# IMPORTS
+from cryptography.fernet import InvalidToken
+from flask.cli import with_appcontext
+from sqlalchemy import bindparam
+from app import db
+from models import User, Draw, decrypt, fingerprint
+import click
+
+
+# fingerprints the draws that don't have a fingerprint yet, or every draw with rebuild, decrypting them a batch at a
+# time. Returns the number of draws fingerprinted
+def backfill_fingerprints(rebuild=False, batch_size=1000):
+    filters = [] if rebuild else [Draw.fingerprint == None]
+    last_id = count = 0
+    while True:
+        rows = db.session.query(Draw.id, Draw.numbers, User.drawkey) \
+            .join(User, Draw.user_id == User.id) \
+            .filter(Draw.id > last_id, *filters) \
+            .order_by(Draw.id) \
+            .limit(batch_size) \
+            .all()
+        if not rows:
+            return count
+        last_id = rows[-1].id
+        fingerprints = []
+        for row in rows:
+            try:
+                fingerprints.append({'draw_id': row.id, 'fingerprint': fingerprint(decrypt(row.numbers, row.drawkey))})
+            except InvalidToken:
+                # draws stored before encryption was added can't be fingerprinted and are left as they are
+                continue
+        if fingerprints:
+            db.session.execute(Draw.__table__.update().where(Draw.id == bindparam('draw_id')), fingerprints)
+            db.session.commit()
+            count += len(fingerprints)
+
+
+# flask backfill-fingerprints
+@click.command('backfill-fingerprints', help="Fingerprint the draws that don't have a fingerprint yet.")
+@click.option('--all', 'rebuild', is_flag=True, help='Fingerprint every draw again, as is needed once '
+                                                     'DRAW_FINGERPRINT_KEY has been changed.')
+@click.option('--batch-size', default=1000, show_default=True, help='Number of draws decrypted at once.')
+@with_appcontext
+def backfill_fingerprints_command(rebuild, batch_size):
+    click.echo('%d draws fingerprinted' % backfill_fingerprints(rebuild, batch_size))
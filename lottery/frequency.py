@@ -0,0 +1,85 @@
+# IMPORTS
+from collections import Counter, defaultdict
+from cryptography.fernet import InvalidToken
+from flask.cli import with_appcontext
+from sqlalchemy import case
+from app import db
+from models import User, Draw, DrawArchive, NumberCount, decrypt
+import click
+
+
+# counts how many of the given draws pick each number. A number picked twice in one draw is counted once, and anything
+# that isn't a number that can be picked isn't counted
+def picks(draws):
+    counts = Counter()
+    for numbers in draws:
+        counts.update({int(number) for number in numbers.split() if number.isdigit()} & set(NumberCount.NUMBERS))
+    return counts
+
+
+# returns how many draws picked each number in a round, most picked first. The round can also be NumberCount.PENDING
+# for the draws not played yet, or NumberCount.TOTAL for every played round together
+def histogram(lottery_round):
+    return db.session.query(NumberCount.number, NumberCount.count) \
+        .filter(NumberCount.lottery_round == lottery_round) \
+        .order_by(NumberCount.count.desc(), NumberCount.number) \
+        .all()
+
+
+# counts the numbers of every user draw from scratch, decrypting the draws a batch at a time, and compares them with
+# the kept counts. With rebuild the kept counts are replaced with the ones counted. Returns the number of counts
+# checked and how many of them were wrong
+def rebuild_number_counts(rebuild=True, batch_size=1000):
+    counts = defaultdict(Counter)
+    # unplayed draws are counted as pending, and played draws in the round they were played in
+    sources = [(Draw, case((Draw.been_played == True, Draw.lottery_round), else_=NumberCount.PENDING),
+                [Draw.master_draw == False]),
+               (DrawArchive, DrawArchive.lottery_round, [])]
+    for model, lottery_round, filters in sources:
+        last_id = 0
+        while True:
+            rows = db.session.query(model.id, model.numbers, lottery_round, User.drawkey) \
+                .join(User, model.user_id == User.id) \
+                .filter(model.id > last_id, *filters) \
+                .order_by(model.id) \
+                .limit(batch_size) \
+                .all()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            for _, numbers, draw_round, drawkey in rows:
+                try:
+                    counts[draw_round].update(picks([decrypt(numbers, drawkey)]))
+                except InvalidToken:
+                    # draws stored before encryption was added can't be read and aren't counted
+                    continue
+
+    # there are always pending counts, even with no draws waiting to be played
+    counts.setdefault(NumberCount.PENDING, Counter())
+    counts[NumberCount.TOTAL] = sum((count for draw_round, count in counts.items() if draw_round > 0), Counter())
+    expected = {(draw_round, number): count[number] for draw_round, count in counts.items()
+                for number in NumberCount.NUMBERS}
+    kept = {(draw_round, number): count for draw_round, number, count in
+            db.session.query(NumberCount.lottery_round, NumberCount.number, NumberCount.count)}
+    wrong = sum(1 for key in expected.keys() | kept.keys() if expected.get(key, 0) != kept.get(key))
+
+    if rebuild and wrong:
+        NumberCount.query.delete()
+        db.session.execute(NumberCount.__table__.insert(),
+                           [{'lottery_round': draw_round, 'number': number, 'count': count}
+                            for (draw_round, number), count in expected.items()])
+        db.session.commit()
+    return len(expected), wrong
+
+
+# flask verify-number-counts
+@click.command('verify-number-counts', help='Check the counts of the numbers players pick against their draws.')
+@click.option('--rebuild', is_flag=True, help='Replace the counts with the ones counted from the draws.')
+@click.option('--batch-size', default=1000, show_default=True, help='Number of draws decrypted at once.')
+@with_appcontext
+def verify_number_counts_command(rebuild, batch_size):
+    checked, wrong = rebuild_number_counts(rebuild, batch_size)
+    if wrong and not rebuild:
+        raise click.ClickException('%d of %d number counts are wrong, run again with --rebuild to fix them'
+                                   % (wrong, checked))
+    click.echo('%d number counts checked, %d %s' % (checked, wrong, 'rebuilt' if wrong else 'wrong'))
@@ -0,0 +1,180 @@
+# IMPORTS
+from datetime import datetime, timedelta
+from sqlalchemy import or_, and_
+from sqlalchemy.exc import IntegrityError
+from flask import current_app
+from app import db
+from models import Draw, Job
+from response_cache import invalidate
+import json
+import logging
+import threading
+
+# guards setting up an app's job runner
+runner_lock = threading.Lock()
+
+# logs errors that stop a worker thread from taking or running a job
+logger = logging.getLogger('lottery.jobs')
+
+
+# raised when a job has been taken by another worker since this worker took it, as its heartbeats stopped for long
+# enough that it looked stale
+class JobTakenOver(Exception):
+    pass
+
+
+# queues the round played against the winning draw, unless it has been queued already. A round that failed is queued
+# again. Returns the round's job, or None if there are no user draws to play
+def enqueue_round(winning_draw):
+    # the lottery engine and numpy are only loaded once a round is played
+    from lottery.engine import unplayed_draws
+
+    job = Job.query.filter_by(winning_draw_id=winning_draw.id, lottery_round=winning_draw.lottery_round).first()
+    if job is None:
+        total, last_id = unplayed_draws()
+        if total == 0:
+            return None
+        job = Job(winning_draw_id=winning_draw.id, lottery_round=winning_draw.lottery_round, total=total,
+                  last_draw_id=last_id)
+        db.session.add(job)
+        try:
+            db.session.commit()
+        # another request queued the same round first
+        except IntegrityError:
+            db.session.rollback()
+            job = Job.query.filter_by(winning_draw_id=winning_draw.id, lottery_round=winning_draw.lottery_round).one()
+    elif job.status == Job.FAILED:
+        job.status = Job.QUEUED
+        job.error = None
+        db.session.commit()
+
+    runner = job_runner()
+    runner.start()
+    runner.wake()
+    return job
+
+
+# returns the app's job runner, setting it up the first time a round is queued
+def job_runner():
+    if 'lottery_jobs' not in current_app.extensions:
+        with runner_lock:
+            if 'lottery_jobs' not in current_app.extensions:
+                current_app.extensions['lottery_jobs'] = JobRunner(current_app._get_current_object())
+    return current_app.extensions['lottery_jobs']
+
+
+# returns the progress of a job, and its results once it is done
+def progress(job):
+    summary = {'id': job.id, 'lottery_round': job.lottery_round, 'status': job.status, 'processed': job.processed,
+               'total': job.total, 'error': job.error}
+    if job.status == Job.DONE:
+        summary.update(json.loads(job.result))
+    return summary
+
+
+# runs queued lottery rounds on background threads. Each thread takes the oldest queued job, or a running job whose
+# worker has stopped sending heartbeats, and plays it from its last checkpoint
+class JobRunner:
+    def __init__(self, app):
+        self.app = app
+        self.threads = []
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+
+    # starts the worker threads if they aren't running yet
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(self.app.config['JOB_WORKERS']):
+                thread = threading.Thread(target=self.run, name='lottery-job-%d' % i, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    # tells idle worker threads to check for new jobs straight away
+    def wake(self):
+        self.event.set()
+
+    def run(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    job = self.claim()
+                    if job is not None:
+                        self.work(job)
+                        continue
+            # an error such as the database being locked is logged and the job tried again, as a thread that stops
+            # isn't started again
+            except Exception:
+                logger.exception('Lottery job worker error')
+            self.event.wait(self.app.config['JOB_POLL_INTERVAL'])
+            self.event.clear()
+
+    # takes the next job to run. A job is only taken if no other worker has taken it since it was read, checked by the
+    # number of times it has been taken
+    def claim(self):
+        stale = datetime.now() - timedelta(seconds=self.app.config['JOB_STALE_SECONDS'])
+        jobs = Job.query.filter(or_(Job.status == Job.QUEUED, and_(Job.status == Job.RUNNING, Job.heartbeat < stale))) \
+            .order_by(Job.id) \
+            .limit(5) \
+            .all()
+        for job in jobs:
+            now = datetime.now()
+            taken = Job.query.filter(Job.id == job.id, Job.attempts == job.attempts) \
+                .update({'status': Job.RUNNING, 'attempts': job.attempts + 1, 'heartbeat': now,
+                         'started_on': job.started_on or now}, synchronize_session=False)
+            db.session.commit()
+            if taken:
+                db.session.refresh(job)
+                return job
+        return None
+
+    # plays a job's round, carrying on from its last checkpoint, and records the results or why it failed. Every write
+    # to the job is only made if no other worker has taken it since, checked by the number of times it has been taken
+    # in the same statement, so a worker whose job was taken over stops before it plays a chunk or finishes the round
+    # a second time
+    def work(self, job):
+        from lottery.engine import run_round
+
+        attempts = job.attempts
+
+        # updates the job if this worker still has it, in the transaction being committed
+        def update(values):
+            if not Job.query.filter(Job.id == job.id, Job.attempts == attempts) \
+                    .update(values, synchronize_session=False):
+                raise JobTakenOver()
+
+        try:
+            winning_draw = db.session.get(Draw, job.winning_draw_id)
+            # the winning draw may have been deleted and its id given to the winning draw of a later round
+            if winning_draw is None or winning_draw.been_played or winning_draw.lottery_round != job.lottery_round:
+                raise RuntimeError('The winning draw for round %d is no longer available.' % job.lottery_round)
+
+            state = json.loads(job.result) if job.result else {}
+
+            # saves the progress of the job with each chunk of draws played
+            def checkpoint(last_draw_id, processed, tiers, winner_ids):
+                update({'checkpoint': last_draw_id, 'processed': processed,
+                        'result': json.dumps({'tiers': tiers, 'winner_ids': winner_ids}), 'heartbeat': datetime.now()})
+                db.session.commit()
+
+            # records the results of the round along with the end of the round
+            def finish(results, stats):
+                update({'status': Job.DONE, 'processed': stats['draws'],
+                        'result': json.dumps(dict(stats, results=results)), 'finished_on': datetime.now()})
+
+            run_round(winning_draw, job.last_draw_id, checkpoint=checkpoint, finish=finish, first_id=job.checkpoint,
+                      processed=job.processed, tiers=state.get('tiers'), winner_ids=state.get('winner_ids'))
+            # the round has been committed, so pages showing the draws and results are out of date
+            invalidate()
+        # the worker that took the job over carries on with it
+        except JobTakenOver:
+            db.session.rollback()
+        except Exception as e:
+            db.session.rollback()
+            try:
+                update({'status': Job.FAILED, 'error': str(e), 'finished_on': datetime.now()})
+                db.session.commit()
+            except JobTakenOver:
+                db.session.rollback()
+
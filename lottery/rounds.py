@@ -0,0 +1,77 @@
+# IMPORTS
+from datetime import datetime
+from cryptography.fernet import InvalidToken
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import case, func
+from app import db
+from models import User, Draw, DrawArchive, Round, decrypt, normalise
+import click
+import json
+
+
+# returns a round's summary with its tier counts and winners decoded
+def summarise(summary):
+    return {'lottery_round': summary.lottery_round, 'winning_numbers': summary.winning_numbers,
+            'entries': summary.entries, 'tiers': json.loads(summary.tiers),
+            'winner_ids': json.loads(summary.winner_ids), 'seconds': summary.seconds,
+            'finished_on': summary.finished_on}
+
+
+# loads one page of round summaries, latest first, before the given round. Returns the rounds on the page and the round
+# to start the next page before, or None on the last page
+def rounds_page(before=None):
+    per_page = current_app.config['ROUNDS_PER_PAGE']
+    query = Round.query
+    if before is not None:
+        query = query.filter(Round.lottery_round < before)
+    rows = query.order_by(Round.lottery_round.desc()).limit(per_page + 1).all()
+    if len(rows) > per_page:
+        return [summarise(row) for row in rows[:per_page]], rows[per_page - 1].lottery_round
+    return [summarise(row) for row in rows], None
+
+
+# fills in the summary of every round played before summaries were kept, from its archived draws. The draws and
+# winners of all those rounds are counted with one grouped query each, rather than reading the draws of each round
+def backfill_rounds():
+    # the lottery engine and numpy are only loaded when they are needed
+    from lottery.engine import PRIZE_TIERS
+
+    known = db.select(Round.lottery_round)
+    counts = db.session.query(DrawArchive.lottery_round, func.count(DrawArchive.id),
+                              *[func.sum(case((DrawArchive.match_count == tier, 1), else_=0)) for tier in PRIZE_TIERS]) \
+        .filter(DrawArchive.lottery_round.not_in(known)) \
+        .group_by(DrawArchive.lottery_round) \
+        .all()
+    winners = {}
+    for lottery_round, user_id in db.session.query(DrawArchive.lottery_round, DrawArchive.user_id) \
+            .filter(DrawArchive.matches_master == True, DrawArchive.lottery_round.not_in(known)) \
+            .distinct():
+        winners.setdefault(lottery_round, []).append(user_id)
+    # played winning draws are kept in the draws table, encrypted with the key of the admin that created them
+    winning = {}
+    for lottery_round, numbers, drawkey in db.session.query(Draw.lottery_round, Draw.numbers, User.drawkey) \
+            .join(User, Draw.user_id == User.id) \
+            .filter(Draw.master_draw == True, Draw.been_played == True, Draw.lottery_round.not_in(known)):
+        try:
+            winning[lottery_round] = normalise(decrypt(numbers, drawkey))
+        except InvalidToken:
+            continue
+
+    now = datetime.now()
+    for lottery_round, entries, *tiers in counts:
+        summary = Round(lottery_round, winning.get(lottery_round))
+        summary.entries = entries
+        summary.tiers = json.dumps(dict(zip(PRIZE_TIERS, [int(count or 0) for count in tiers])))
+        summary.winner_ids = json.dumps(sorted(winners.get(lottery_round, [])))
+        summary.finished_on = now
+        db.session.add(summary)
+    db.session.commit()
+    return len(counts)
+
+
+# flask backfill-rounds
+@click.command('backfill-rounds', help='Fill in the summary of rounds played before round summaries were kept.')
+@with_appcontext
+def backfill_rounds_command():
+    click.echo('%d rounds summarised' % backfill_rounds())
@@ -1,8 +1,12 @@
 # IMPORTS
-from flask import Blueprint, render_template, request, flash
-from sqlalchemy.orm import make_transient
+from flask import Blueprint, render_template, request, flash, current_app, jsonify
 from app import db, roles_required
-from models import Draw
+from response_cache import cached, invalidate
+from sqlalchemy import func, true
+from models import Draw, DrawArchive, NumberCount, Round, count_numbers, decrypt_many
+from lottery.bulk import BadUpload, TooManyDraws, read_csv, read_json, submit_draws, validate
+from lottery.rounds import summarise
+from lottery.frequency import picks
 from flask_login import current_user, login_required
 
 # CONFIG
@@ -14,6 +18,7 @@ lottery_blueprint = Blueprint('lottery', __name__, template_folder='templates')
 @lottery_blueprint.route('/lottery')
 @login_required
 @roles_required('user')
+@cached()
 def lottery():
     return render_template('lottery/lottery.html')
 
@@ -22,56 +27,125 @@ def lottery():
 @login_required
 @roles_required('user')
 def add_draw():
-    submitted_draw = ''
-    for i in range(6):
-        submitted_draw += request.form.get('no' + str(i + 1)) + ' '
-    submitted_draw.strip()
+    # checks the form holds six different whole numbers between 1 and 60, the same as draws submitted in bulk
+    submitted_draw, error = validate([request.form.get('no' + str(i + 1), '') for i in range(6)])
+    if error:
+        flash('Draw not submitted. %s.' % error)
+        return lottery()
 
     # create a new draw with the form data.
     new_draw = Draw(user_id=current_user.id, numbers=submitted_draw, master_draw=False, lottery_round=0,
                     drawkey=current_user.drawkey)  # TODO: update user_id [user_id=1 is a placeholder]
 
-    # add the new draw to the database
+    # add the new draw to the database, counting its numbers along with it
     db.session.add(new_draw)
+    count_numbers(NumberCount.PENDING, picks([submitted_draw]))
     db.session.commit()
+    invalidate(current_user.id)
 
     # re-render lottery.page
     flash('Draw %s submitted.' % submitted_draw)
     return lottery()
 
 
-# view all draws that have not been played
+# submit many draws at once, as a JSON list of draws or an uploaded CSV file with one draw per row
+@lottery_blueprint.route('/add_draws', methods=['POST'])
+@login_required
+@roles_required('user')
+def add_draws():
+    limit = current_app.config['BULK_DRAW_LIMIT']
+    if request.is_json:
+        draws = read_json(request.get_json(silent=True))
+    elif request.files.get('draws'):
+        try:
+            draws = read_csv(request.files['draws'], limit)
+        except BadUpload:
+            flash('Draws not submitted. The file must be a CSV file of numbers saved as UTF-8.')
+            return lottery()
+    else:
+        draws = []
+
+    try:
+        summary = submit_draws(draws, current_user.id, current_user.drawkey, limit,
+                               current_app.config['BULK_INSERT_BATCH'])
+    except TooManyDraws:
+        if request.is_json:
+            return jsonify({'error': 'At most %d draws can be submitted at once.' % limit}), 413
+        flash('At most %d draws can be submitted at once.' % limit)
+        return lottery()
+    invalidate(current_user.id)
+
+    accepted = sum(1 for row in summary if row['accepted'])
+    if request.is_json:
+        return jsonify({'accepted': accepted, 'rejected': len(summary) - accepted, 'rows': summary})
+
+    # re-render lottery page with the draws that were rejected
+    flash('%d draws submitted, %d rejected.' % (accepted, len(summary) - accepted))
+    return render_template('lottery/lottery.html', rejected=[row for row in summary if not row['accepted']])
+
+
+# loads one page of draws after the given draw id, keeping one extra draw to tell whether there is a next page. Returns
+# the draws on the page and the id to start the next page after, or None on the last page
+def draws_page(query, id_column, after):
+    per_page = current_app.config['DRAWS_PER_PAGE']
+    rows = query.filter(id_column > after) \
+        .order_by(id_column) \
+        .limit(per_page + 1) \
+        .all()
+    if len(rows) > per_page:
+        return rows[:per_page], rows[per_page - 1].id
+    return rows, None
+
+
+# decrypts the draws on a page together, as they are all encrypted with the user's key
+def decrypted(rows):
+    numbers = decrypt_many([row.numbers for row in rows], current_user.drawkey)
+    return [dict(row._mapping, numbers=draw_numbers) for row, draw_numbers in zip(rows, numbers)]
+
+
+# view draws that have not been played, a page at a time
 @lottery_blueprint.route('/view_draws', methods=['POST'])
 @login_required
 @roles_required('user')
+@cached()
 def view_draws():
-    # get all draws that have not been played [played=0]
-    playable_draws = Draw.query.filter_by(been_played=False, user_id=current_user.id).all()  # TODO: filter playable draws for current user
-    # iterates through all playable draws and gets corresponding encryption key to decrypt draws for user to see
-    for draws in playable_draws:
-        make_transient(draws)
-        draws.view_draw(current_user.drawkey)
+    # get a page of the user's draws that have not been played [played=0]
+    playable_draws, next_after = draws_page(
+        db.session.query(Draw.id, Draw.numbers).filter(Draw.user_id == current_user.id, Draw.been_played == False),
+        Draw.id, request.form.get('after', 0, type=int))
 
     # if playable draws exist
     if len(playable_draws) != 0:
         # re-render lottery page with playable draws
-        return render_template('lottery/lottery.html', playable_draws=playable_draws)
+        return render_template('lottery/lottery.html', playable_draws=decrypted(playable_draws),
+                               next_after=next_after)
     else:
         flash('No playable draws.')
         return lottery()
 
 
-# view lottery results
+# view lottery results, a page at a time
 @lottery_blueprint.route('/check_draws', methods=['POST'])
 @login_required
 @roles_required('user')
+@cached()
 def check_draws():
-    # get played draws
-    played_draws = Draw.query.filter_by(been_played=True, user_id=current_user.id).all()  # TODO: filter played draws for current user
+    # played draws are kept in the archive, where the results of the last round the user played in are shown
+    lottery_round = db.session.query(func.max(DrawArchive.lottery_round)) \
+        .filter(DrawArchive.user_id == current_user.id) \
+        .scalar()
+    played_draws, next_after = draws_page(
+        db.session.query(DrawArchive.id, DrawArchive.numbers, true().label('been_played'), DrawArchive.matches_master,
+                         DrawArchive.match_count, DrawArchive.lottery_round)
+        .filter(DrawArchive.user_id == current_user.id, DrawArchive.lottery_round == lottery_round),
+        DrawArchive.id, request.form.get('after', 0, type=int))
 
     # if played draws exist
     if len(played_draws) != 0:
-        return render_template('lottery/lottery.html', results=played_draws, played=True)
+        # the round's results come from its summary rather than from the draws of every player
+        summary = db.session.get(Round, lottery_round)
+        return render_template('lottery/lottery.html', results=decrypted(played_draws), played=True,
+                               next_after=next_after, round_summary=summarise(summary) if summary else None)
 
     # if no played draws exist [all draw entries have been played therefore wait for next lottery round]
     else:
@@ -79,15 +153,14 @@ def check_draws():
         return lottery()
 
 
-# delete all played draws
+# start playing the next round. Played draws are moved to the archive when their round is run, so there is nothing left
+# to delete here
 @lottery_blueprint.route('/play_again', methods=['POST'])
 @login_required
 @roles_required('user')
 def play_again():
-    Draw.query.filter_by(been_played=True, master_draw=False, user_id=current_user.id).delete(synchronize_session=False)
-    db.session.commit()
-
-    flash("All played draws deleted.")
+    invalidate(current_user.id)
+    flash("Played draws have been archived. Submit draws for the next round.")
     return lottery()
 
 
@@ -0,0 +1,127 @@
+# IMPORTS
+from collections import Counter
+from flask import g, has_request_context, request
+from sqlalchemy import event
+import bisect
+import logging
+import threading
+import time
+
+# upper bounds of the buckets request and query times are counted in, in seconds
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# upper bounds of the buckets the number of queries run by a request are counted in
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# logs requests that ran more queries than they should when the query budget is checked
+logger = logging.getLogger('metrics')
+
+
+# counts observed values in a fixed set of buckets along with their total, so it takes the same memory however many
+# values it has seen
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # the last count is for values above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    # returns the cumulative count of values up to each bucket, ending with +Inf, as prometheus expects
+    def cumulative(self):
+        running = 0
+        for bound, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            running += count
+            yield bound, running
+
+
+# records how long each endpoint takes to respond and how many database queries it runs, and how long they take.
+# Queries are counted on the request they are run for with events on the app's own engine, and queries run outside a
+# request, such as by lottery jobs, aren't counted. Each app keeps its own metrics in app.extensions['metrics']
+class Metrics:
+    # histograms kept for each endpoint, with their prometheus name and help text
+    SERIES = (('lottery_request_seconds', 'Time taken to respond to a request', SECONDS_BUCKETS),
+              ('lottery_request_queries', 'Database queries run by a request', QUERY_BUCKETS),
+              ('lottery_request_query_seconds', 'Time spent running database queries by a request', SECONDS_BUCKETS))
+
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.query_budget = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        # a query budget is only checked in debug mode, where requests that go over it are logged
+        if app.config['METRICS_DEBUG']:
+            self.query_budget = app.config['METRICS_QUERY_BUDGET']
+            logger.setLevel(logging.WARNING)
+            if not logger.handlers:
+                logger.addHandler(logging.StreamHandler())
+        app.before_request(self.start_request)
+        app.after_request(self.end_request)
+        # only the queries of this app's engine are counted. The database is set up on the app before its metrics
+        with app.app_context():
+            engine = app.extensions['sqlalchemy'].engine
+        event.listen(engine, 'before_cursor_execute', self.start_query)
+        event.listen(engine, 'after_cursor_execute', self.end_query)
+
+    def start_request(self):
+        g.metrics_start = time.perf_counter()
+        g.metrics_queries = 0
+        g.metrics_query_seconds = 0.0
+        g.metrics_statements = Counter() if self.query_budget else None
+
+    def end_request(self, response):
+        if 'metrics_start' not in g:
+            return response
+        seconds = time.perf_counter() - g.metrics_start
+        endpoint = request.endpoint or 'unmatched'
+        with self.lock:
+            if endpoint not in self.endpoints:
+                self.endpoints[endpoint] = tuple(Histogram(buckets) for _, _, buckets in self.SERIES)
+            for histogram, value in zip(self.endpoints[endpoint], (seconds, g.metrics_queries,
+                                                                   g.metrics_query_seconds)):
+                histogram.observe(value)
+
+        # the statement run most often is logged with the request, as it is usually the one run in a loop
+        if self.query_budget and g.metrics_queries > self.query_budget:
+            statement, times = g.metrics_statements.most_common(1)[0]
+            logger.warning('%s %s ran %d queries (budget %d) in %.1fms, most often %dx: %s', request.method,
+                           request.path, g.metrics_queries, self.query_budget, seconds * 1000, times,
+                           ' '.join(statement.split()))
+        return response
+
+    # checks the query is being run for a request, rather than by a background thread such as a lottery job's
+    def counting(self):
+        return has_request_context() and 'metrics_start' in g
+
+    def start_query(self, conn, cursor, statement, parameters, context, executemany):
+        if self.counting():
+            conn.info.setdefault('metrics_query_start', []).append(time.perf_counter())
+
+    def end_query(self, conn, cursor, statement, parameters, context, executemany):
+        if self.counting() and conn.info.get('metrics_query_start'):
+            g.metrics_queries += 1
+            g.metrics_query_seconds += time.perf_counter() - conn.info['metrics_query_start'].pop()
+            if g.metrics_statements is not None:
+                g.metrics_statements[statement] += 1
+
+    # returns the metrics in the prometheus text format
+    def prometheus(self):
+        lines = []
+        with self.lock:
+            for i, (name, help_text, _) in enumerate(self.SERIES):
+                lines.append('# HELP %s %s' % (name, help_text))
+                lines.append('# TYPE %s histogram' % name)
+                for endpoint, histograms in sorted(self.endpoints.items()):
+                    histogram = histograms[i]
+                    for bound, count in histogram.cumulative():
+                        lines.append('%s_bucket{endpoint="%s",le="%s"} %d' % (name, endpoint, bound, count))
+                    lines.append('%s_sum{endpoint="%s"} %s' % (name, endpoint, histogram.total))
+                    lines.append('%s_count{endpoint="%s"} %d' % (name, endpoint, histogram.count))
+        return '\n'.join(lines) + '\n'
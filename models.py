@@ -1,12 +1,21 @@
 from datetime import datetime
+from functools import lru_cache
+from flask import current_app
 from flask_login import UserMixin
-from app import db, app
-from cryptography.fernet import Fernet
-import bcrypt
+from app import db, create_app
+from users.hashing import hash_password
+from cryptography.fernet import Fernet, MultiFernet
+from sqlalchemy import bindparam, event, inspect, text
+import hashlib
+import hmac
 import pyotp
 
 class User(db.Model, UserMixin):
     __tablename__ = 'users'
+    # admins list users by role, searching by the start of their last name or email. These indexes also serve
+    # looking users up by role alone, so role isn't indexed on its own
+    __table_args__ = (db.Index('ix_users_role_lastname', 'role', 'lastname'),
+                      db.Index('ix_users_role_email', 'role', 'email'))
 
     id = db.Column(db.Integer, primary_key=True)
 
@@ -25,9 +34,13 @@ class User(db.Model, UserMixin):
     current_login = db.Column(db.DateTime, nullable=True)
     last_login = db.Column(db.DateTime, nullable=True)
 
-    # encryption key for draws
+    # encryption key for draws. While the key is being rotated this holds the new key and the old key separated by a
+    # comma, so draws encrypted with either can be read
     drawkey = db.Column(db.BLOB)
 
+    # id of the last draw re-encrypted with the new draw key while the key is being rotated, None otherwise
+    rotation_checkpoint = db.Column(db.Integer, nullable=True)
+
     # key used to generate time based pin for user login
     pinkey = db.Column(db.String(100), nullable=False)
 
@@ -41,7 +54,7 @@ class User(db.Model, UserMixin):
         self.phone = phone
 
         # hashes password before storing in database
-        self.password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+        self.password = hash_password(password)
 
         # generates key to be used for time based login for user
         self.pinkey = pyotp.random_base32()
@@ -55,8 +68,36 @@ class User(db.Model, UserMixin):
         self.role = role
 
 
+# a copy of the parts of a user that are needed on every request, kept in the identity cache instead of reloading the
+# user from the database. The password and time based pin key are deliberately left out
+class Identity(UserMixin):
+    def __init__(self, user):
+        self.id = user.id
+        self.email = user.email
+        self.firstname = user.firstname
+        self.lastname = user.lastname
+        self.phone = user.phone
+        self.role = user.role
+        self.drawkey = user.drawkey
+
+
+# removes a user from the identity cache whenever they are changed so the next request sees the change
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def invalidate_identity(mapper, connection, user):
+    current_app.extensions['identity_cache'].invalidate(user.id)
+
+
 class Draw(db.Model):
     __tablename__ = 'draws'
+    # indexes matching how draws are looked up: a user's played or unplayed draws, the master or user draws of the
+    # current round, and the unplayed user draws with a given fingerprint. Ids are never used again once a draw has
+    # been deleted or moved to the archive, where it keeps its id, so SQLite is told to always give out a new one
+    __table_args__ = (db.Index('ix_draws_user_id_been_played', 'user_id', 'been_played'),
+                      db.Index('ix_draws_master_draw_been_played', 'master_draw', 'been_played'),
+                      db.Index('ix_draws_fingerprint_master_draw_been_played', 'fingerprint', 'master_draw',
+                               'been_played'),
+                      {'sqlite_autoincrement': True})
 
     id = db.Column(db.Integer, primary_key=True)
 
@@ -78,32 +119,319 @@ class Draw(db.Model):
     # Lottery round that draw is used
     lottery_round = db.Column(db.Integer, nullable=False, default=0)
 
+    # How many of the master draw's numbers the draw matched once played
+    match_count = db.Column(db.Integer, nullable=True)
+
+    # keyed hash of the sorted draw numbers, used to find matching draws without decrypting them
+    fingerprint = db.Column(db.String(64), nullable=True)
+
     def __init__(self, user_id, numbers, master_draw, lottery_round, drawkey):
         self.user_id = user_id
         # encrypts draw numbers for database
         self.numbers = encrypt(numbers, drawkey)
+        self.fingerprint = fingerprint(numbers)
         self.been_played = False
         self.matches_master = False
         self.master_draw = master_draw
         self.lottery_round = lottery_round
 
+    # returns the column values of a new draw, so many draws can be inserted at once without creating a Draw for each
+    @staticmethod
+    def values(user_id, numbers, master_draw, lottery_round, drawkey):
+        return {'user_id': user_id, 'numbers': encrypt(numbers, drawkey), 'been_played': False,
+                'matches_master': False, 'master_draw': master_draw, 'lottery_round': lottery_round,
+                'fingerprint': fingerprint(numbers)}
+
     # creates a function to view numbers on draw
     def view_draw(self, drawkey):
         self.numbers = decrypt(self.numbers, drawkey)
 
 
+# separates the new and old keys of a draw key being rotated
+KEY_SEPARATOR = b','
+
+
+# sets up the Fernet instance for a draw key. A key being rotated gets a MultiFernet, which encrypts with the new key
+# and decrypts with either
+def make_cipher(drawkey):
+    if KEY_SEPARATOR in drawkey:
+        return MultiFernet([Fernet(key) for key in drawkey.split(KEY_SEPARATOR)])
+    return Fernet(drawkey)
+
+
+# keeps the Fernet instances of the most recently used draw keys so a key isn't set up again for every draw it
+# encrypts or decrypts. The cache is sized by init_models, and is kept at module level rather than on the app so lottery
+# worker processes can use it without an app
+cipher_cache = lru_cache(maxsize=1024)(make_cipher)
+
+
+# returns the Fernet instance for a draw key from the cache. The cache is looked up when this is called, so modules that
+# imported this function use the cache init_models sized rather than the one there was when they were imported
+def cipher(drawkey):
+    return cipher_cache(drawkey)
+
+
+# sizes the draw key cache for an app, keeping the cache as it is if it is already the right size
+def init_models(app):
+    global cipher_cache
+    if cipher_cache.cache_parameters()['maxsize'] != app.config['FERNET_CACHE_SIZE']:
+        cipher_cache = lru_cache(maxsize=app.config['FERNET_CACHE_SIZE'])(make_cipher)
+
+
+# hit and miss counts of the draw key cache
+def cipher_cache_info():
+    return cipher_cache.cache_info()
+
+
+class DrawArchive(db.Model):
+    __tablename__ = 'draws_archive'
+    # results are looked up by user and round, and a user's draws are read in id order when their draw key is rotated
+    __table_args__ = (db.Index('ix_draws_archive_user_id_lottery_round', 'user_id', 'lottery_round'),
+                      db.Index('ix_draws_archive_user_id', 'user_id'))
+
+    # same id the draw had while it was being played
+    id = db.Column(db.Integer, primary_key=True)
+
+    # ID of user who submitted draw
+    user_id = db.Column(db.Integer, db.ForeignKey(User.id), nullable=False)
+
+    # 6 draw numbers submitted, still encrypted with the user's draw key
+    numbers = db.Column(db.String(100), nullable=False)
+
+    # Draw matched the master draw of its round, and how many of its numbers matched
+    matches_master = db.Column(db.BOOLEAN, nullable=False, default=False)
+    match_count = db.Column(db.Integer, nullable=True)
+
+    # Lottery round that draw was played in
+    lottery_round = db.Column(db.Integer, nullable=False)
+
+
+class Round(db.Model):
+    __tablename__ = 'rounds'
+
+    # summary of a lottery round, filled in as the round is played so its results can be looked up without reading its
+    # draws
+    lottery_round = db.Column(db.Integer, primary_key=True, autoincrement=False)
+
+    # winning numbers of the round
+    winning_numbers = db.Column(db.String(100), nullable=True)
+
+    # number of user draws played in the round so far
+    entries = db.Column(db.Integer, nullable=False, default=0)
+
+    # number of draws matching each prize tier, and the ids of the users with a winning draw, as JSON
+    tiers = db.Column(db.Text, nullable=False, default='{}')
+    winner_ids = db.Column(db.Text, nullable=False, default='[]')
+
+    # seconds spent playing the round, and when it finished. A round still being played has no finish time
+    seconds = db.Column(db.Float, nullable=False, default=0.0)
+    finished_on = db.Column(db.DateTime, nullable=True)
+
+    def __init__(self, lottery_round, winning_numbers):
+        self.lottery_round = lottery_round
+        self.winning_numbers = winning_numbers
+        self.entries = 0
+        self.tiers = '{}'
+        self.winner_ids = '[]'
+        self.seconds = 0.0
+
+
+class NumberCount(db.Model):
+    __tablename__ = 'number_counts'
+
+    # rows for the draws that haven't been played yet and for every played round together, kept alongside the rows of
+    # each round
+    PENDING, TOTAL = 0, -1
+
+    # numbers a draw can pick from
+    NUMBERS = range(1, 61)
+
+    # how many user draws picked a number in a lottery round
+    lottery_round = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    number = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+
+class CacheGeneration(db.Model):
+    __tablename__ = 'cache_generations'
+
+    # owner of the generation of the winning draw and lottery rounds. Every other owner is the id of a user, whose
+    # generation is that of their draws
+    ROUND = 0
+
+    # generation of the data shown by the pages in the response cache. It is kept in the database rather than in the
+    # cache so a change made through any process serving the app is seen by all of them
+    owner = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    generation = db.Column(db.Integer, nullable=False, default=0)
+
+
+# makes sure a round has a count for every number, starting the missing ones at 0
+def add_number_counts(lottery_round):
+    existing = {number for number, in db.session.query(NumberCount.number)
+                .filter(NumberCount.lottery_round == lottery_round)}
+    missing = [{'lottery_round': lottery_round, 'number': number, 'count': 0}
+               for number in NumberCount.NUMBERS if number not in existing]
+    if missing:
+        db.session.execute(NumberCount.__table__.insert(), missing)
+
+
+# adds to the counts of a round's numbers with one executemany, taking away for negative amounts. counts maps each
+# number to the amount to add
+def count_numbers(lottery_round, counts):
+    table = NumberCount.__table__
+    values = [{'count_round': lottery_round, 'count_number': number, 'amount': amount}
+              for number, amount in counts.items() if amount]
+    if values:
+        db.session.execute(table.update()
+                           .where(table.c.lottery_round == bindparam('count_round'),
+                                  table.c.number == bindparam('count_number'))
+                           .values(count=table.c.count + bindparam('amount')), values)
+
+
+# moves played user draws out of the draws table into the archive with one INSERT ... SELECT and one DELETE, so the
+# draws table only holds the draws of the round being played
+def archive_draws(*filters):
+    columns = ['id', 'user_id', 'numbers', 'matches_master', 'match_count', 'lottery_round']
+    played = Draw.__table__.select() \
+        .with_only_columns(*[Draw.__table__.c[column] for column in columns]) \
+        .where(Draw.master_draw == False, Draw.been_played == True, *filters)
+    db.session.execute(DrawArchive.__table__.insert().from_select(columns, played))
+    Draw.query.filter(Draw.master_draw == False, Draw.been_played == True, *filters).delete(synchronize_session=False)
+
+
+class Job(db.Model):
+    __tablename__ = 'jobs'
+    # a lottery round can only be queued once
+    __table_args__ = (db.UniqueConstraint('winning_draw_id', 'lottery_round'),)
+
+    # states a job moves through
+    QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    # winning draw and lottery round the job plays
+    winning_draw_id = db.Column(db.Integer, nullable=False)
+    lottery_round = db.Column(db.Integer, nullable=False)
+
+    status = db.Column(db.String(20), nullable=False, default=QUEUED, index=True)
+
+    # number of user draws in the round and the id of the last of them, fixed when the round is queued
+    total = db.Column(db.Integer, nullable=False)
+    last_draw_id = db.Column(db.Integer, nullable=False)
+
+    # progress so far: the id of the last draw played, how many draws have been played, and the tier counts and winners
+    # found (as JSON). Once the job is done, result holds the results of the round instead
+    checkpoint = db.Column(db.Integer, nullable=False, default=0)
+    processed = db.Column(db.Integer, nullable=False, default=0)
+    result = db.Column(db.Text, nullable=True)
+    error = db.Column(db.Text, nullable=True)
+
+    # number of times a worker has taken the job, used so only one worker can take it at a time
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+
+    created_on = db.Column(db.DateTime, nullable=False)
+    started_on = db.Column(db.DateTime, nullable=True)
+    finished_on = db.Column(db.DateTime, nullable=True)
+    # last time the worker running the job showed it was still alive
+    heartbeat = db.Column(db.DateTime, nullable=True)
+
+    def __init__(self, winning_draw_id, lottery_round, total, last_draw_id):
+        self.winning_draw_id = winning_draw_id
+        self.lottery_round = lottery_round
+        self.status = Job.QUEUED
+        self.total = total
+        self.last_draw_id = last_draw_id
+        self.checkpoint = 0
+        self.processed = 0
+        self.attempts = 0
+        self.created_on = datetime.now()
+
+
 # function for encrypting data
 def encrypt(data, drawkey):
-    return Fernet(drawkey).encrypt(bytes(data, 'utf-8'))
+    return cipher(drawkey).encrypt(bytes(data, 'utf-8'))
 
 
 # function for decrypting data
 def decrypt(data, drawkey):
-    return Fernet(drawkey).decrypt(data).decode('utf-8')
+    return cipher(drawkey).decrypt(data).decode('utf-8')
+
+
+# function for decrypting several pieces of data encrypted with the same key
+def decrypt_many(rows, drawkey):
+    fernet = cipher(drawkey)
+    return [fernet.decrypt(data).decode('utf-8') for data in rows]
+
+
+# puts draw numbers in a standard form so the same numbers in any order or spacing compare equal
+def normalise(numbers):
+    return ' '.join(str(number) for number in sorted(int(number) for number in numbers.split()))
+
+
+# function for fingerprinting draw numbers with a key only the server knows, so fingerprints can't be reversed by
+# hashing every possible draw
+def fingerprint(numbers):
+    return hmac.new(current_app.config['DRAW_FINGERPRINT_KEY'].encode('utf-8'), normalise(numbers).encode('utf-8'),
+                    hashlib.sha256).hexdigest()
+
+
+# rebuilds a draws table made without AUTOINCREMENT, as SQLite can't add it to an existing table. SQLite would
+# otherwise give a new draw the id after the highest one left in the table, which can be the id of a draw already
+# moved to the archive or of a deleted winning draw. New ids are started after the highest id in either table
+def rebuild_draws():
+    table = Draw.__table__
+    created = db.session.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'draws'")).scalar()
+    if 'AUTOINCREMENT' in created.upper():
+        return
+    for index in inspect(db.engine).get_indexes('draws'):
+        db.session.execute(text('DROP INDEX %s' % index['name']))
+    db.session.execute(text('ALTER TABLE draws RENAME TO draws_rebuild'))
+    db.session.commit()
+    table.create(db.engine)
+    columns = ', '.join(column.name for column in table.columns)
+    db.session.execute(text('INSERT INTO draws (%s) SELECT %s FROM draws_rebuild' % (columns, columns)))
+    db.session.execute(text('DROP TABLE draws_rebuild'))
+    last_id = db.session.execute(text('SELECT max(id) FROM (SELECT id FROM draws UNION ALL '
+                                      'SELECT id FROM draws_archive)')).scalar()
+    db.session.execute(text("DELETE FROM sqlite_sequence WHERE name = 'draws'"))
+    db.session.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES ('draws', :last_id)"),
+                       {'last_id': last_id or 0})
+    db.session.commit()
+
+
+# brings an existing database up to date with the current models without dropping any data
+def migrate_db(app=None):
+    with (app or create_app()).app_context():
+        counted = inspect(db.engine).has_table('number_counts')
+        # creates any tables that don't exist yet
+        db.create_all()
+        columns = [column['name'] for column in inspect(db.engine).get_columns('draws')]
+        if 'match_count' not in columns:
+            db.session.execute(text('ALTER TABLE draws ADD COLUMN match_count INTEGER'))
+        if 'fingerprint' not in columns:
+            db.session.execute(text('ALTER TABLE draws ADD COLUMN fingerprint VARCHAR(64)'))
+        if 'rotation_checkpoint' not in [column['name'] for column in inspect(db.engine).get_columns('users')]:
+            db.session.execute(text('ALTER TABLE users ADD COLUMN rotation_checkpoint INTEGER'))
+        db.session.commit()
+        if db.engine.dialect.name == 'sqlite':
+            rebuild_draws()
+        for table in (User.__table__, Draw.__table__, DrawArchive.__table__):
+            for index in table.indexes:
+                index.create(db.engine, checkfirst=True)
+        # draws added before they were fingerprinted are fingerprinted from their numbers
+        from lottery.fingerprints import backfill_fingerprints
+        backfill_fingerprints()
+        # draws played before the archive existed are moved into it
+        archive_draws()
+        db.session.commit()
+        # numbers picked before they were counted are counted from the draws
+        if not counted:
+            from lottery.frequency import rebuild_number_counts
+            rebuild_number_counts()
 
 
-def init_db():
-    with app.app_context():
+def init_db(app=None):
+    with (app or create_app()).app_context():
         db.drop_all()
         db.create_all()
         admin = User(email='admin@email.com',
@@ -114,4 +442,6 @@ def init_db():
                      role='admin')
 
         db.session.add(admin)
+        add_number_counts(NumberCount.PENDING)
+        add_number_counts(NumberCount.TOTAL)
         db.session.commit()
@@ -0,0 +1,90 @@
+# IMPORTS
+from collections import OrderedDict
+from flask import current_app, request
+from threading import Lock
+import math
+import time
+
+
+# counts attempts per key, such as an IP address or an email, over a sliding window and says when a key has made too
+# many. Each key only keeps the count of the current and the previous window, and the previous window's count is
+# weighted by how much of it still overlaps the sliding window, so checking and counting an attempt takes the same time
+# however many attempts have been made. A limited number of keys are kept, dropping the least recently used first
+class RateLimiter:
+    def __init__(self, limit, window, maxsize):
+        self.limit = limit
+        self.window = window
+        self.maxsize = maxsize
+        # key -> [start of the current window, attempts in it, attempts in the previous window]
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    # moves a key's counts on to the window the given time falls in
+    def roll(self, entry, now):
+        periods = int((now - entry[0]) // self.window)
+        if periods == 1:
+            entry[:] = [entry[0] + self.window, 0, entry[1]]
+        elif periods > 1:
+            entry[:] = [now, 0, 0]
+
+    # estimated number of attempts made by a key in the last window
+    def count(self, entry, now):
+        self.roll(entry, now)
+        return entry[2] * (1 - (now - entry[0]) / self.window) + entry[1]
+
+    # counts an attempt against each of the keys
+    def hit(self, *keys):
+        now = time.monotonic()
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is None:
+                    entry = self.entries[key] = [now, 0, 0]
+                self.roll(entry, now)
+                entry[1] += 1
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    # returns the fewest attempts any of the keys has left before it is limited
+    def remaining(self, *keys):
+        now = time.monotonic()
+        with self.lock:
+            counts = [self.count(self.entries[key], now) for key in keys if key in self.entries]
+        return max(0, self.limit - math.ceil(max(counts, default=0)))
+
+    def limited(self, *keys):
+        return self.remaining(*keys) == 0
+
+    # forgets the attempts of the keys
+    def reset(self, *keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+
+# keys attempts are counted against: the client's IP address, and the email the attempt was for if there is one
+def attempt_keys(email=None):
+    keys = [('ip', request.remote_addr)]
+    if email:
+        keys.append(('email', email.strip().lower()))
+    return keys
+
+
+# checks if the client, or the email an attempt is for, has made too many failed attempts
+def throttled(email=None):
+    return current_app.extensions['rate_limiter'].limited(*attempt_keys(email))
+
+
+# counts a failed attempt against the client and the email it was for. Returns how many attempts are left
+def count_attempt(email=None):
+    limiter = current_app.extensions['rate_limiter']
+    keys = attempt_keys(email)
+    limiter.hit(*keys)
+    return limiter.remaining(*keys)
+
+
+# forgets the failed attempts made for an email once its user has logged in. The client's attempts are kept, so
+# logging in to one account doesn't reset the count of attempts on others
+def clear_attempts(email):
+    current_app.extensions['rate_limiter'].reset(*attempt_keys(email)[1:])
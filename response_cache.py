@@ -0,0 +1,115 @@
+# IMPORTS
+from datetime import datetime, timezone
+from functools import wraps
+from flask import current_app, request, session, g, message_flashed
+from flask_login import current_user
+from sqlalchemy.exc import IntegrityError
+from cache import TTLCache
+import hashlib
+
+
+# keeps rendered pages so read-mostly views don't query the database and render their template on every hit. Pages are
+# kept per user, or per role for pages that are the same for everyone, and are served with an ETag and Last-Modified
+# time so browsers can revalidate them with a conditional GET.
+# Instead of finding and removing the pages affected by a change, each page is stored under the generation of the data
+# it shows: one generation for the winning draw and lottery rounds, and one for each user's draws. Changing the data
+# moves its generation on, so the pages stored under the old one are never looked up again and age out of the cache.
+# Each process keeps its own pages, but the generations are kept in the database and read on every request, so a
+# change made through one process is seen by the others straight away
+class ResponseCache:
+    def __init__(self, app=None):
+        self.cache = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.cache = TTLCache(app.config['RESPONSE_CACHE_SIZE'], app.config['RESPONSE_CACHE_TTL'])
+        message_flashed.connect(self.flashed, app)
+        app.extensions['response_cache'] = self
+
+    # notes that the request flashed a message, as a page showing a message is only right for that request
+    def flashed(self, sender, message, category):
+        g.response_cache_flashed = True
+
+    # moves on the generation of the winning draw and lottery rounds, or of one user's draws if a user is given. This is
+    # committed straight away, so it should be called once the change to the data has been committed
+    def bump(self, user_id=None):
+        from app import db
+        from models import CacheGeneration
+
+        owner = CacheGeneration.ROUND if user_id is None else user_id
+        moved = CacheGeneration.query.filter_by(owner=owner) \
+            .update({'generation': CacheGeneration.generation + 1}, synchronize_session=False)
+        if not moved:
+            db.session.add(CacheGeneration(owner=owner, generation=1))
+        try:
+            db.session.commit()
+        # another process added the generation first
+        except IntegrityError:
+            db.session.rollback()
+            CacheGeneration.query.filter_by(owner=owner) \
+                .update({'generation': CacheGeneration.generation + 1}, synchronize_session=False)
+            db.session.commit()
+
+    # the key a page is stored under: the view and what was asked of it, who it is for and the generations of the data
+    # it shows, read with one query
+    def key(self, name, per_user):
+        from app import db
+        from models import CacheGeneration
+
+        owners = [CacheGeneration.ROUND, current_user.id] if per_user else [CacheGeneration.ROUND]
+        generations = dict(db.session.query(CacheGeneration.owner, CacheGeneration.generation)
+                           .filter(CacheGeneration.owner.in_(owners)))
+        if per_user:
+            owner = ('user', current_user.id, generations.get(current_user.id, 0))
+        else:
+            owner = ('role', current_user.role if current_user.is_authenticated else None)
+        return (name, request.method, tuple(sorted(request.values.items(multi=True))), owner,
+                generations.get(CacheGeneration.ROUND, 0))
+
+    # returns the stored page for the request, rendering and storing it first if there isn't one
+    def respond(self, view, name, per_user, args, kwargs):
+        # a message waiting to be shown has to be rendered into the page
+        if '_flashes' in session:
+            return view(*args, **kwargs)
+
+        key = self.key(name, per_user)
+        entry = self.cache.get(key)
+        if entry is None:
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code != 200 or response.direct_passthrough or g.get('response_cache_flashed'):
+                return response
+            body = response.get_data()
+            entry = (body, response.mimetype, hashlib.sha256(body).hexdigest(),
+                     datetime.now(timezone.utc).replace(microsecond=0))
+            self.cache.set(key, entry)
+
+        body, mimetype, etag, last_modified = entry
+        response = current_app.response_class(body, mimetype=mimetype)
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        # answers a conditional GET for a page that hasn't changed with 304 Not Modified
+        return response.make_conditional(request)
+
+    def stats(self):
+        return self.cache.stats()
+
+
+# serves a view from the response cache. Pages are kept per user unless per_user is False, when they are shared by
+# everyone with the same role
+def cached(per_user=True):
+    def wrapper(f):
+        @wraps(f)
+        def wrapped(*args, **kwargs):
+            name = f.__module__ + '.' + f.__qualname__
+            return current_app.extensions['response_cache'].respond(f, name, per_user, args, kwargs)
+
+        return wrapped
+
+    return wrapper
+
+
+# drops the stored pages showing the winning draw and lottery results, or those showing a user's draws if a user is
+# given
+def invalidate(user_id=None):
+    current_app.extensions['response_cache'].bump(user_id)
@@ -0,0 +1,146 @@
+# IMPORTS
+from datetime import datetime
+from flask import request
+from logging.handlers import QueueHandler, WatchedFileHandler
+import json
+import logging
+import os
+import queue
+import threading
+
+
+# defines a filter class that will only return logged records of security events
+class SecurityFilter(logging.Filter):
+    def filter(self, record):
+        return hasattr(record, 'security')
+
+
+# formats security events as one JSON object per line so the log can be read by tools without parsing the message
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'time': datetime.fromtimestamp(record.created).isoformat(timespec='seconds')}
+        entry.update(record.security)
+        return json.dumps(entry)
+
+
+# appends security events to the log file a batch at a time. Every process serving the app appends to the same file,
+# so the file is never rotated here, as one process renaming it would lose the events the others are writing. Each
+# batch is written to the end of the file with a single write, so batches from different processes can't overwrite or
+# split each other. The file can be rotated by an outside tool such as logrotate, and is reopened once it has been moved
+class BatchFileHandler(WatchedFileHandler):
+    def __init__(self, filename):
+        super().__init__(filename, 'a', encoding='utf-8')
+        self.lines = []
+
+    def emit(self, record):
+        try:
+            self.lines.append(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+
+    def flush_batch(self):
+        if not self.lines:
+            return
+        self.acquire()
+        try:
+            self.reopenIfNeeded()
+            self.stream.write(''.join(self.lines))
+            self.stream.flush()
+            self.lines = []
+        finally:
+            self.release()
+
+
+# puts records on the listener's queue for it to write out
+class BlockingQueueHandler(QueueHandler):
+    def __init__(self, writer, timeout):
+        super().__init__(None)
+        self.writer = writer
+        self.timeout = timeout
+
+    def enqueue(self, record):
+        self.writer.put(record, self.timeout)
+
+
+# writes the records put on a bounded queue to a handler from a background thread. Whatever is waiting on the queue is
+# taken off together, up to the batch size, written and flushed to disk in one go. When the queue is full a request
+# waits for space for up to the timeout, so a slow disk slows requests down instead of the queue growing without limit.
+# Records that still don't fit are dropped and counted.
+# Each process gets its own queue and thread the first time it logs. A worker forked from a process that had already
+# started logging, as with a server started with --preload, has a copy of the parent's queue but not the thread
+# writing it out, so it would otherwise fill the queue and drop every event from then on
+class BatchingQueueListener:
+    # put on the queue to tell the listener to stop
+    STOP = object()
+
+    def __init__(self, handler, queue_size, batch_size):
+        self.handler = handler
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.queue = None
+        self.thread = None
+        self.pid = None
+        self.dropped = 0
+        self.lock = threading.Lock()
+        # the lock may have been held by another thread of the parent when the process was forked
+        os.register_at_fork(after_in_child=self.forked)
+
+    def forked(self):
+        self.lock = threading.Lock()
+
+    # queues a record, starting the listener first if it isn't running in this process yet
+    def put(self, record, timeout):
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.start()
+        try:
+            self.queue.put(record, timeout=timeout)
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        self.queue = queue.Queue(self.queue_size)
+        self.dropped = 0
+        # records the parent was part way through writing when it was forked are left for the parent to write
+        self.handler.lines = []
+        self.thread = threading.Thread(target=self.run, name='security-log', daemon=True)
+        self.thread.start()
+        self.pid = os.getpid()
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            for record in batch:
+                if record is self.STOP:
+                    stopping = True
+                else:
+                    self.handler.handle(record)
+            self.handler.flush_batch()
+
+    # writes out everything still on the queue and stops the listener, called when the process exits
+    def stop(self):
+        if self.thread is not None and self.pid == os.getpid():
+            self.queue.put(self.STOP)
+            self.thread.join()
+            self.thread = None
+            self.pid = None
+            self.handler.close()
+
+    # returns the number of records this process has dropped in the prometheus text format
+    def prometheus(self):
+        return '# HELP lottery_security_log_dropped_total Security events dropped because the log queue was full\n' \
+               '# TYPE lottery_security_log_dropped_total counter\n' \
+               'lottery_security_log_dropped_total %d\n' % self.dropped
+
+
+# logs a security event with the details of who caused it and where from
+def log_security(event, user_id=None, email=None, role=None):
+    security = {'event': event, 'user_id': user_id, 'email': email, 'role': role, 'ip': request.remote_addr}
+    logging.warning('SECURITY - %s', event, extra={'security': security})
@@ -1,5 +1,5 @@
 from flask_wtf import FlaskForm, RecaptchaField
-from wtforms import StringField, SubmitField, PasswordField
+from wtforms import Form, StringField, SubmitField, PasswordField
 from wtforms.validators import DataRequired, Email, ValidationError, EqualTo
 import re
 
@@ -52,3 +52,13 @@ class LoginForm(FlaskForm):
     pin = StringField(validators=[DataRequired()])
     recaptcha = RecaptchaField()
     submit = SubmitField()
+
+
+# checks each row of a bulk user import with the same rules as registration. It isn't a FlaskForm as rows don't come
+# from a request, so have no CSRF token or recaptcha
+class ImportForm(Form):
+    email = StringField(validators=[DataRequired(), Email()])
+    firstname = StringField(validators=[DataRequired(), character_check])
+    lastname = StringField(validators=[DataRequired(), character_check])
+    phone = StringField(validators=[DataRequired(), validate_phone])
+    password = PasswordField(validators=[DataRequired(), validate_password])
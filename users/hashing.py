@@ -0,0 +1,56 @@
+# IMPORTS
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+from flask import current_app
+import bcrypt
+
+# guards setting up an app's hashing pool
+pool_lock = Lock()
+
+
+# raised when too many passwords are already being hashed to take on another one
+class HashingBusy(Exception):
+    pass
+
+
+# returns the app's hashing pool, setting it up the first time a password is hashed.
+# bcrypt releases the GIL while it hashes, so password hashing runs on its own small pool of threads. This limits how
+# much CPU a burst of logins can take up, however many requests are being served at once. The semaphore limits how many
+# hashes can be running or waiting at once, so requests beyond that are turned away straight away instead of queueing
+# up behind each other
+def pool():
+    if 'bcrypt' not in current_app.extensions:
+        with pool_lock:
+            if 'bcrypt' not in current_app.extensions:
+                workers = current_app.config['BCRYPT_WORKERS']
+                current_app.extensions['bcrypt'] = (
+                    ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bcrypt'),
+                    BoundedSemaphore(workers + current_app.config['BCRYPT_QUEUE_SIZE']))
+    return current_app.extensions['bcrypt']
+
+
+# runs a hashing function on the hashing pool and waits for its result
+def run(function, *args):
+    executor, slots = pool()
+    if not slots.acquire(blocking=False):
+        raise HashingBusy()
+    try:
+        return executor.submit(function, *args).result()
+    finally:
+        slots.release()
+
+
+# hashes a password with the configured cost factor
+def hash_password(password):
+    return run(bcrypt.hashpw, password.encode('utf-8'), bcrypt.gensalt(current_app.config['BCRYPT_ROUNDS']))
+
+
+# checks a password against a stored hash
+def check_password(password, hashed):
+    return run(bcrypt.checkpw, password.encode('utf-8'), hashed)
+
+
+# checks if a stored hash was made with a different cost factor to the configured one, the cost is the second field of
+# the hash e.g. $2b$12$...
+def needs_rehash(hashed):
+    return int(hashed.split(b'$')[2]) != current_app.config['BCRYPT_ROUNDS']
@@ -0,0 +1,113 @@
+# IMPORTS
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from cryptography.fernet import Fernet
+from flask import current_app
+from flask.cli import with_appcontext
+from app import db
+from models import User
+from users.forms import ImportForm
+import bcrypt
+import click
+import csv
+import os
+import pyotp
+import time
+
+# columns an import file must have, one user per row
+COLUMNS = ['email', 'firstname', 'lastname', 'phone', 'password']
+
+
+# hashes a user's password and makes their time based pin key and draw key. This runs in a worker process, so it only
+# takes and returns plain values
+def make_secrets(password, rounds):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)), pyotp.random_base32(), \
+        Fernet.generate_key()
+
+
+# reads the rows of an import file a batch at a time, numbering each row by its line in the file
+def read_batches(file, batch_size):
+    batch = []
+    for line, row in enumerate(csv.DictReader(file), start=2):
+        batch.append((line, row))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# checks a row against the registration rules. Returns the reason the row was rejected, or None if it is valid
+def validate(row):
+    form = ImportForm(data={column: (row.get(column) or '').strip() for column in COLUMNS})
+    if form.validate():
+        return None
+    return '; '.join('%s: %s' % (field, ' '.join(errors)) for field, errors in form.errors.items())
+
+
+# imports the users in a CSV file, a batch at a time. Each batch is checked against the registration rules and for
+# emails that are repeated or already registered, with one query for the whole batch. The passwords of the rows left
+# are hashed across a pool of processes, and the users are inserted with one statement. Rows that can't be imported
+# are written to the reject file with the reason why. Returns the number of rows read, imported and rejected
+def import_users(file, rejects, batch_size, workers):
+    rounds = current_app.config['BCRYPT_ROUNDS']
+    writer = csv.writer(rejects)
+    writer.writerow(['line'] + COLUMNS + ['error'])
+    read = imported = 0
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for batch in read_batches(file, batch_size):
+            read += len(batch)
+            valid = []
+            for line, row in batch:
+                error = validate(row)
+                if error:
+                    writer.writerow([line] + [row.get(column) for column in COLUMNS] + [error])
+                else:
+                    valid.append((line, {column: row[column].strip() for column in COLUMNS}))
+
+            emails = [row['email'] for _, row in valid]
+            registered = {email for email, in db.session.query(User.email).filter(User.email.in_(emails))}
+            new = []
+            for line, row in valid:
+                if row['email'] in registered:
+                    writer.writerow([line] + [row[column] for column in COLUMNS] + ['Email address already exists'])
+                else:
+                    # later rows with the same email in the batch are rejected as already existing
+                    registered.add(row['email'])
+                    new.append(row)
+
+            secrets = executor.map(make_secrets, [row['password'] for row in new], [rounds] * len(new),
+                                   chunksize=max(1, len(new) // (workers * 4)))
+            now = datetime.now()
+            users = [{'email': row['email'], 'password': password, 'firstname': row['firstname'],
+                      'lastname': row['lastname'], 'phone': row['phone'], 'role': 'user', 'registered_on': now,
+                      'pinkey': pinkey, 'drawkey': drawkey}
+                     for row, (password, pinkey, drawkey) in zip(new, secrets)]
+            if users:
+                db.session.execute(User.__table__.insert(), users)
+                db.session.commit()
+            imported += len(users)
+    return read, imported, read - imported
+
+
+# flask import-users users.csv
+@click.command('import-users',
+               help='Import users from a CSV file with email, firstname, lastname, phone and password columns.')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--rejects', default='rejects.csv', show_default=True, help='File the rejected rows are written to.')
+@click.option('--batch-size', default=1000, show_default=True, help='Number of rows checked and inserted at once.')
+@click.option('--workers', default=os.cpu_count() or 1, show_default=True,
+              help='Number of processes hashing passwords.')
+@with_appcontext
+def import_users_command(path, rejects, batch_size, workers):
+    start = time.perf_counter()
+    with open(path, newline='', encoding='utf-8') as file, open(rejects, 'w', newline='', encoding='utf-8') as out:
+        missing = set(COLUMNS) - set(csv.DictReader(file).fieldnames or [])
+        if missing:
+            raise click.UsageError('%s is missing the columns %s' % (path, ', '.join(sorted(missing))))
+        file.seek(0)
+        read, imported, rejected = import_users(file, out, batch_size, workers)
+    seconds = time.perf_counter() - start
+    click.echo('%d rows read, %d imported, %d rejected (see %s) in %.1fs, %.0f rows/sec'
+               % (read, imported, rejected, rejects, seconds, read / seconds if seconds else 0))
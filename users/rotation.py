@@ -0,0 +1,132 @@
+# IMPORTS
+from cryptography.fernet import Fernet, InvalidToken
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import bindparam
+from app import db
+from models import User, Draw, DrawArchive, KEY_SEPARATOR, cipher
+import click
+import time
+
+
+# puts a new draw key in front of a user's key, so draws added from now on are encrypted with the new key while the
+# draws already stored can still be read with the old one. A user whose key is already being rotated is left as it is,
+# so an interrupted rotation carries on from its checkpoint
+def start_rotation(user):
+    if KEY_SEPARATOR not in user.drawkey:
+        user.drawkey = Fernet.generate_key() + KEY_SEPARATOR + user.drawkey
+        user.rotation_checkpoint = 0
+        db.session.commit()
+
+
+# reads a user's draws and archived draws with an id after the given one a batch at a time, in id order. Each query
+# reads a range of one of the indexes on the user's draws, so a batch takes the same time however many draws the user
+# has
+def draw_batches(user_id, after, batch_size):
+    sources = [(Draw.__table__, [Draw.been_played == False]), (Draw.__table__, [Draw.been_played == True]),
+               (DrawArchive.__table__, [])]
+    while True:
+        rows = []
+        for table, filters in sources:
+            query = db.select(table.c.id, table.c.numbers) \
+                .where(table.c.user_id == user_id, table.c.id > after, *filters) \
+                .order_by(table.c.id) \
+                .limit(batch_size)
+            rows.extend((table, row.id, row.numbers) for row in db.session.execute(query))
+        if not rows:
+            return
+        rows = sorted(rows, key=lambda row: row[1])[:batch_size]
+        after = rows[-1][1]
+        yield rows
+
+
+# re-encrypts a user's draws after their checkpoint with the new key, one batch at a time, moving the checkpoint on as
+# each batch is committed. Returns the number of draws re-encrypted
+def reencrypt(user, batch_size):
+    fernet = cipher(user.drawkey)
+    count = 0
+    for batch in draw_batches(user.id, user.rotation_checkpoint, batch_size):
+        for table in (Draw.__table__, DrawArchive.__table__):
+            values = []
+            for source, draw_id, numbers in batch:
+                if source is not table:
+                    continue
+                try:
+                    values.append({'draw_id': draw_id, 'numbers': fernet.rotate(numbers)})
+                except InvalidToken:
+                    # draws stored before encryption was added can't be re-encrypted and are left as they are
+                    continue
+            if values:
+                db.session.execute(table.update().where(table.c.id == bindparam('draw_id')), values)
+        user.rotation_checkpoint = batch[-1][1]
+        db.session.commit()
+        count += len(batch)
+    return count
+
+
+# re-encrypts any draws added with the old key since the user's draws were last re-encrypted, then drops the old key
+def finish_rotation(user, batch_size):
+    count = reencrypt(user, batch_size)
+    user.drawkey = user.drawkey.split(KEY_SEPARATOR)[0]
+    user.rotation_checkpoint = None
+    db.session.commit()
+    return count
+
+
+# loads the users a query matches a group at a time, in order of id
+def user_groups(query, group_size):
+    after = 0
+    while True:
+        group = query.filter(User.id > after).order_by(User.id).limit(group_size).all()
+        if not group:
+            return
+        after = group[-1].id
+        yield group
+
+
+# gives every user, or only the given user, a new draw key and re-encrypts their draws with it. Other processes can keep
+# a user's old key in their identity cache until it expires, and couldn't read a draw re-encrypted with the new key, so
+# every user is started a group at a time first and their draws are only re-encrypted once that long has passed since
+# the last user was started. There is a second wait before the old keys are dropped, so draws added with an old key by
+# requests that loaded it before the rotation started are re-encrypted by the finish. Returns the number of users
+# rotated and draws re-encrypted
+def rotate_draw_keys(batch_size, group_size, user_id=None):
+    wait = current_app.config['IDENTITY_CACHE_TTL']
+    query = User.query
+    if user_id is not None:
+        query = query.filter(User.id == user_id)
+    rotated = draws = 0
+
+    for group in user_groups(query.filter(User.drawkey != None), group_size):
+        for user in group:
+            start_rotation(user)
+
+    # users started by this run, or by an earlier one that was interrupted, which may have been just before it stopped
+    started_users = query.filter(User.rotation_checkpoint != None)
+    if started_users.first() is None:
+        return rotated, draws
+    time.sleep(wait)
+    for group in user_groups(started_users, group_size):
+        for user in group:
+            draws += reencrypt(user, batch_size)
+    time.sleep(wait)
+    for group in user_groups(started_users, group_size):
+        for user in group:
+            draws += finish_rotation(user, batch_size)
+        rotated += len(group)
+    return rotated, draws
+
+
+# flask rotate-drawkeys
+@click.command('rotate-drawkeys', help='Give users new draw keys and re-encrypt their draws. Safe to run again if it '
+                                       'is interrupted, carrying on from where each user got to.')
+@click.option('--batch-size', default=1000, show_default=True, help='Number of draws re-encrypted at once.')
+@click.option('--group-size', default=100, show_default=True, help='Number of users rotated at once.')
+@click.option('--user-id', type=int, default=None, help='Only rotate the key of this user.')
+@with_appcontext
+def rotate_drawkeys_command(batch_size, group_size, user_id):
+    start = time.perf_counter()
+    rotated, draws = rotate_draw_keys(batch_size, group_size, user_id)
+    seconds = time.perf_counter() - start
+    click.echo('%d users rotated, %d draws re-encrypted in %.1fs, %.0f draws/sec'
+               % (rotated, draws, seconds, draws / seconds if seconds else 0))
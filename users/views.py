@@ -1,13 +1,13 @@
 # IMPORTS
-from flask import Blueprint, render_template, flash, redirect, url_for, session, request
+from flask import Blueprint, render_template, flash, redirect, url_for, request
 from flask_login import login_user, current_user, logout_user, login_required
-from markupsafe import Markup
 from app import db, roles_required
+from security_log import log_security
+from rate_limit import clear_attempts, count_attempt, throttled
 from models import User
 from users.forms import RegisterForm, LoginForm
+from users.hashing import HashingBusy, check_password, hash_password, needs_rehash
 from datetime import datetime
-import logging
-import bcrypt
 import pyotp
 
 # CONFIG
@@ -18,11 +18,18 @@ users_blueprint = Blueprint('users', __name__, template_folder='templates')
 # view registration
 @users_blueprint.route('/register', methods=['GET', 'POST'])
 def register():
+    # clients that have made too many attempts are turned away before any database or bcrypt work
+    if request.method == 'POST' and throttled():
+        flash('Too many attempts, please try again later.')
+        return render_template('users/register.html', form=RegisterForm()), 429
+
     # create signup form object
     form = RegisterForm()
 
     # if request method is POST or form is valid
     if form.validate_on_submit():
+        # each registration counts against the client's attempts
+        count_attempt()
         user = User.query.filter_by(email=form.email.data).first()
         # if this returns a user, then the email already exists in database
 
@@ -31,15 +38,20 @@ def register():
             flash('Email address already exists')
             return render_template('users/register.html', form=form)
         # logs a new user registration
-        logging.warning('SECURITY - User registration [%s, %s]', form.email.data, request.remote_addr)
+        log_security('User registration', email=form.email.data)
 
         # create a new user with the form data
-        new_user = User(email=form.email.data,
-                        firstname=form.firstname.data,
-                        lastname=form.lastname.data,
-                        phone=form.phone.data,
-                        password=form.password.data,
-                        role='user')
+        try:
+            new_user = User(email=form.email.data,
+                            firstname=form.firstname.data,
+                            lastname=form.lastname.data,
+                            phone=form.phone.data,
+                            password=form.password.data,
+                            role='user')
+        # if too many passwords are being hashed already ask the user to try again
+        except HashingBusy:
+            flash('The server is busy, please try again.')
+            return render_template('users/register.html', form=form)
 
         # add the new user to the database
         db.session.add(new_user)
@@ -54,44 +66,59 @@ def register():
 # view user login
 @users_blueprint.route('/login', methods=['GET', 'POST'])
 def login():
-    # initialises a key-value pair to keep track of the number of login attempts
-    if not session.get('authentication_attempts'):
-        session['authentication_attempts'] = 0
+    # clients or emails that have made too many failed attempts are blocked from logging in before any database or
+    # bcrypt work, by not passing a form to the html
+    if request.method == 'POST' and throttled(request.form.get('email')):
+        flash('Number of incorrect login attempts exceeded. Please try again later.')
+        return render_template('users/login.html'), 429
     # create login form object
     form = LoginForm()
 
     # if request method is POST or form is valid
     if form.validate_on_submit():
         user = User.query.filter_by(email=form.email.data).first()
-        if not user \
-                or not bcrypt.checkpw(form.password.data.encode('utf-8'), user.password) \
-                or not pyotp.TOTP(user.pinkey).verify(form.pin.data):
+        try:
+            valid = user \
+                and check_password(form.password.data, user.password) \
+                and pyotp.TOTP(user.pinkey).verify(form.pin.data)
+        # if too many passwords are being checked already ask the user to try again without counting it as a failed
+        # attempt
+        except HashingBusy:
+            flash('The server is busy, please try again.')
+            return render_template('users/login.html', form=form)
+        if not valid:
             # if the data input by the form is not a real user or the password or time based pin doesn't match runs code
             # below
             # logs invalid log in attempt
-            logging.warning('SECURITY - Invalid Login Attempt [%s, %s]', form.email.data, request.remote_addr)
-            # increases the number of authentication attempts stored by session by 1 for failed login attempt
-            session['authentication_attempts'] += 1
-            # if the user has exceeded the maximum number of failed login attempts(3) blocks the user from logging in
-            # by not passing a form to the html and provides a valid error message with a link to reset login attempts
-            if session.get('authentication_attempts') >= 3:
-                flash(Markup('Number of incorrect login attempts exceeded. Please click '
-                             '<a href="/reset">here</a> to reset.'))
+            log_security('Invalid Login Attempt', email=form.email.data)
+            # counts the failed attempt against the client's IP address and the email it was for
+            remaining = count_attempt(form.email.data)
+            # if the client or email has run out of login attempts blocks the user from logging in by not passing a form
+            # to the html
+            if remaining == 0:
+                flash('Number of incorrect login attempts exceeded. Please try again later.')
                 return render_template('users/login.html')
             # if the user has not exceeded the login attempts provides an error message to let the user know the login
             # failed and how many attempts they have left to login before being locked out
-            flash('Please check your login details and try again, {} login attempts remaining'
-                  .format(3 - session.get('authentication_attempts')))
+            flash('Please check your login details and try again, {} login attempts remaining'.format(remaining))
             return render_template('users/login.html', form=form)
         else:
             # if the users credentials are correct log's in the user and updates value of users last login in database
             login_user(user)
+            clear_attempts(user.email)
             user.last_login = user.current_login
             user.current_login = datetime.now()
+            # rehashes the password if it was hashed with a different cost factor to the one now configured
+            if needs_rehash(user.password):
+                try:
+                    user.password = hash_password(form.password.data)
+                except HashingBusy:
+                    # the password is rehashed on a later login instead
+                    pass
             db.session.add(user)
             db.session.commit()
             # logs successful login attempt
-            logging.warning('SECURITY - Log in [%d, %s, %s]', current_user.id, current_user.email, request.remote_addr)
+            log_security('Log in', current_user.id, current_user.email, current_user.role)
             # redirects user to page depending on their role after logging in
             if current_user.role == 'user':
                 return redirect(url_for('users.profile'))
@@ -101,19 +128,12 @@ def login():
     return render_template('users/login.html', form=form)
 
 
-# resets the number of login attempts and reloads the user.login page
-@users_blueprint.route('/reset')
-def reset():
-    session['authentication_attempts'] = 0
-    return redirect(url_for('users.login'))
-
-
 # logs the current user out and redirects anonymous user to home page
 @users_blueprint.route('/logout')
 @login_required
 @roles_required('admin', 'user')
 def logout():
-    logging.warning('SECURITY - Log Out [%d, %s, %s]', current_user.id, current_user.email, request.remote_addr)
+    log_security('Log Out', current_user.id, current_user.email, current_user.role)
     logout_user()
     return redirect(url_for('index'))
 